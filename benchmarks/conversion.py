@@ -0,0 +1,293 @@
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+from benchmarks.firmwareimage import make_image
+
+
+# Drives a tcfrontend server through full conversions over HTTP, with tuya-convert replaced by the transcript
+# simulator, and reports how long each state took to be reached along with the server's CPU time and peak RSS
+SIMULATOR_CMD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulator', 'start_flash.sh')
+TRANSCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transcripts')
+PORT = 8880
+SPEED = 10
+ITERATIONS = 3
+FIRMWARE_SIZE = 300 * 1024
+STARTUP_TIMEOUT = 10
+STATE_TIMEOUT = 300
+
+FINAL_STATES = {
+    'converting': {'converted', 'conversion-error', 'conversion-cancelled'},
+    'flashing': {'flashed', 'flashing-error'}
+}
+
+
+def run_server(port: int, tc_dir: str, speed: float) -> None:
+    from tcfrontend import main
+    from tcfrontend import staticfiles
+    from tcfrontend import tccontrol
+    from tcfrontend import webserver
+
+    # Same layout as a real tuya-convert checkout, with start_flash.sh replaced by the simulator
+    tc_process = tccontrol.TCProcess
+    tc_process.TUYA_CONVERT_DIR = tc_dir
+    tc_process.BACKUPS_DIR = os.path.join(tc_dir, 'backups')
+    tc_process.BACKUP_STORE_DIR = os.path.join(tc_process.BACKUPS_DIR, 'store')
+    tc_process.FIRMWARE_CACHE_DIR = os.path.join(tc_dir, 'firmware-cache')
+    tc_process.FIRMWARE_LIBRARY_DIR = os.path.join(tc_dir, 'firmware-library')
+    tc_process.PHASE_DURATIONS_FILE = os.path.join(tc_dir, 'phase-durations.json')
+    tc_process.SKIP_BACKUP_FLAG_FILE = os.path.join(tc_dir, '_skip_backup')
+    tc_process.CUSTOM_FIRMWARE_FILE = os.path.join(tc_dir, 'files', '_custom.bin')
+    tc_process.BATCH_FIRMWARE_FILE = os.path.join(tc_dir, '_batch.bin')
+    tc_process.RETRY_FIRMWARE_FILE = os.path.join(tc_dir, '_retry.bin')
+    tc_process.CMD = SIMULATOR_CMD
+
+    # Timeouts covering recorded delays shrink along with them, so that error variants fail in reasonable time
+    tc_process.PHASE_TIMEOUTS = {
+        phase: tuple(max(t / speed, tc_process.DEFAULT_EXPECT_TIMEOUT) for t in timeouts)
+        for phase, timeouts in tc_process.PHASE_TIMEOUTS.items()
+    }
+
+    main.init_logging()
+    logging.getLogger('tornado').setLevel(logging.WARNING)
+    staticfiles.build()
+
+    webserver.make_app().listen(port, address='127.0.0.1')
+
+    asyncio.get_event_loop().create_task(main.init())
+    asyncio.get_event_loop().run_forever()
+
+
+def start_server(
+    port: int,
+    transcript: str,
+    speed: float,
+    extra_env: Optional[Dict[str, str]] = None
+) -> Tuple[subprocess.Popen, str]:
+    tc_dir = tempfile.mkdtemp(prefix='tcfrontend-bench-')
+    os.makedirs(os.path.join(tc_dir, 'backups'))
+    os.makedirs(os.path.join(tc_dir, 'files'))
+
+    env = dict(os.environ)
+    env['TC_SIM_TRANSCRIPT'] = os.path.join(TRANSCRIPTS_DIR, transcript)
+    env['TC_SIM_SPEED'] = str(speed)
+    env.update(extra_env or {})
+
+    # Server logs at debug level, like on a real device, to a file rather than to the terminal
+    cmd = [
+        sys.executable, '-m', 'benchmarks.conversion',
+        '--server', tc_dir, '--port', str(port), '--speed', str(speed)
+    ]
+    with open(os.path.join(tc_dir, 'tcfrontend.log'), 'w') as log:
+        server = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    return server, tc_dir
+
+
+def stop_server(server: subprocess.Popen, tc_dir: str) -> None:
+    server.terminate()
+    server.wait()
+    shutil.rmtree(tc_dir, ignore_errors=True)
+
+
+def get_process_stats(pid: int) -> Tuple[float, int, int]:
+    # CPU time in seconds, current and peak RSS in bytes, of the process itself (not of tuya-convert)
+    with open(f'/proc/{pid}/stat', 'rb') as f:
+        fields = f.read().rsplit(b')', 1)[1].split()
+
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    rss = peak_rss = 0
+    with open(f'/proc/{pid}/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+
+            elif line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1]) * 1024
+
+    return cpu, rss, peak_rss
+
+
+class StateFollower:
+    # Follows /status/events, recording each state update along with the time it arrived at
+    def __init__(self, port: int) -> None:
+        self._url = f'http://127.0.0.1:{port}/status/events'
+        self._buffer = b''
+        self._updates: List[Tuple[str, float]] = []
+        self._changed_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._follow())
+
+    async def stop(self) -> None:
+        # Stream ends along with the server
+        if self._task:
+            await self._task
+
+    def get_position(self) -> int:
+        return len(self._updates)
+
+    async def _follow(self) -> None:
+        request = HTTPRequest(self._url, streaming_callback=self._on_chunk, request_timeout=0)
+        try:
+            await AsyncHTTPClient().fetch(request)
+
+        except HTTPClientError:
+            pass  # Server has gone away
+
+    def _on_chunk(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        *events, self._buffer = self._buffer.split(b'\n\n')
+        for event in events:
+            for line in event.split(b'\n'):
+                if line.startswith(b'data: '):
+                    self._updates.append((json.loads(line[6:])['state'], time.monotonic()))
+                    self._changed_event.set()
+
+    async def wait(self, position: int, states: Set[str], timeout: float) -> List[Tuple[str, float]]:
+        # Returns the states passed through since the given position, with the time each was first reached at, up to
+        # one of the given states
+        seen: List[Tuple[str, float]] = []
+        deadline = time.monotonic() + timeout
+        while True:
+            for state, update_time in self._updates[position:]:
+                position += 1
+                if not seen or seen[-1][0] != state:
+                    seen.append((state, update_time))
+
+                if state in states:
+                    return seen
+
+            self._changed_event.clear()
+            await asyncio.wait_for(self._changed_event.wait(), deadline - time.monotonic())
+
+
+async def request_state(port: int, state: str, params: Dict[str, Any]) -> None:
+    request = HTTPRequest(
+        f'http://127.0.0.1:{port}/status',
+        method='PATCH',
+        body=json.dumps({'state': state, 'params': params}),
+        headers={'Content-Type': 'application/json'},
+        request_timeout=STATE_TIMEOUT
+    )
+    await AsyncHTTPClient().fetch(request)
+
+
+async def wait_server(port: int) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            await AsyncHTTPClient().fetch(f'http://127.0.0.1:{port}/status')
+            return
+
+        except (OSError, HTTPClientError):
+            if time.monotonic() > deadline:
+                raise
+
+            await asyncio.sleep(0.1)
+
+
+async def run_step(
+    port: int,
+    follower: StateFollower,
+    state: str,
+    params: Dict[str, Any],
+    timings: Dict[Tuple[str, str], List[float]]
+) -> str:
+    position = follower.get_position()
+    start = time.monotonic()
+    await request_state(port, state, params)
+    seen = await follower.wait(position, FINAL_STATES[state], STATE_TIMEOUT)
+
+    for seen_state, seen_time in seen:
+        timings.setdefault((state, seen_state), []).append(seen_time - start)
+
+    return seen[-1][0]
+
+
+async def run_client(port: int, server: subprocess.Popen, iterations: int, download_backup: bool) -> None:
+    firmware = base64.urlsafe_b64encode(make_image(FIRMWARE_SIZE)).decode()
+    timings: Dict[Tuple[str, str], List[float]] = {}
+    outcomes: Dict[str, int] = {}
+
+    await wait_server(port)
+    follower = StateFollower(port)
+    follower.start()
+    await follower.wait(0, {'ready'}, STARTUP_TIMEOUT)
+
+    start_cpu, _, _ = get_process_stats(server.pid)
+    start = time.monotonic()
+
+    try:
+        for _ in range(iterations):
+            final_state = await run_step(port, follower, 'converting', {'download_backup': download_backup}, timings)
+            if final_state == 'converted':
+                params = {'firmware': firmware, 'patch_header': True}
+                final_state = await run_step(port, follower, 'flashing', params, timings)
+
+            outcomes[final_state] = outcomes.get(final_state, 0) + 1
+
+        duration = time.monotonic() - start
+        cpu, _, peak_rss = get_process_stats(server.pid)
+        cpu -= start_cpu
+
+    finally:
+        server.terminate()
+        await follower.stop()
+
+    print(f'{"requested":>12} {"reached":>18} {"count":>6} {"min":>9} {"median":>9} {"max":>9}')
+    for (requested, reached), values in timings.items():
+        print(
+            f'{requested:>12} {reached:>18} {len(values):>6} '
+            f'{min(values):>8.3f}s {statistics.median(values):>8.3f}s {max(values):>8.3f}s'
+        )
+
+    print(f'outcomes: {", ".join(f"{k}: {v}" for k, v in sorted(outcomes.items()))}')
+    print(f'wall time: {duration:.2f}s')
+    print(f'cpu time: {cpu:.3f}s ({cpu / iterations:.3f}s per iteration)')
+    print(f'peak rss: {peak_rss / (1024 * 1024):.1f}MB')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='End-to-end conversion benchmark against simulated tuya-convert')
+    parser.add_argument('--transcript', default='conversion.jsonl', help='transcript from benchmarks/transcripts')
+    parser.add_argument('--speed', type=float, default=SPEED, help='factor to speed up recorded timing by')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--no-backup', action='store_true', help='skip original firmware backup')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--server', metavar='TC_DIR', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.server:
+        run_server(args.port, args.server, args.speed)
+        return
+
+    print(f'transcript: {args.transcript}, speed: {args.speed}x, iterations: {args.iterations}')
+
+    server, tc_dir = start_server(args.port, args.transcript, args.speed)
+
+    try:
+        asyncio.run(run_client(args.port, server, args.iterations, not args.no_backup))
+
+    finally:
+        stop_server(server, tc_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+
+import mmap
+import os
+import tempfile
+import timeit
+
+from tcfrontend import firmwareimage
+
+
+SIZES_MB = [1, 2, 3, 4]
+SEGMENTS = 4
+NUMBER = 10000
+
+
+def make_image(size: int) -> bytearray:
+    data = bytearray(size)
+    data[0:4] = bytes([firmwareimage.MAGIC, SEGMENTS, firmwareimage.FLASH_MODES['QIO'], 0x40])
+
+    # Spread segments over the whole image, so that walking them covers the entire file
+    segment_len = (size - firmwareimage.HEADER_SIZE) // SEGMENTS - firmwareimage.SEGMENT_HEADER_SIZE
+    offset = firmwareimage.HEADER_SIZE
+    for i in range(SEGMENTS):
+        data[offset + 4:offset + 8] = segment_len.to_bytes(4, 'little')
+        offset += firmwareimage.SEGMENT_HEADER_SIZE + segment_len
+
+    return data
+
+
+def bench_memory(data: bytearray) -> float:
+    flash_params = {'flash_mode': 'DOUT', 'flash_size': 1, 'flash_freq': 40}
+
+    def run() -> None:
+        view = memoryview(data)
+        firmwareimage.parse_header(view)
+        firmwareimage.patch_flash_params(view, flash_params)
+        view.release()
+
+    return timeit.timeit(run, number=NUMBER) / NUMBER
+
+
+def bench_mmap(data: bytearray) -> float:
+    flash_params = {'flash_mode': 'DOUT', 'flash_size': 1, 'flash_freq': 40}
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+
+    # Same steps as TCProcess.check_firmware()
+    def run() -> None:
+        with open(path, 'r+b') as f, mmap.mmap(f.fileno(), 0) as m:
+            view = memoryview(m)
+            firmwareimage.parse_header(view)
+            firmwareimage.patch_flash_params(view, flash_params)
+            view.release()
+
+    try:
+        return timeit.timeit(run, number=NUMBER) / NUMBER
+
+    finally:
+        os.remove(path)
+
+
+def bench_copy(data: bytearray) -> float:
+    # Baseline: what a naive parser would cost, copying the image once
+    return timeit.timeit(lambda: bytes(data), number=NUMBER // 100) / (NUMBER // 100)
+
+
+def main() -> None:
+    print(f'{"size":>6} {"memoryview":>12} {"mmap file":>12} {"one copy":>12}')
+    for size_mb in SIZES_MB:
+        data = make_image(size_mb * 1024 * 1024)
+        print(
+            f'{size_mb:>4}MB '
+            f'{bench_memory(data) * 1e6:>10.2f}us '
+            f'{bench_mmap(data) * 1e6:>10.2f}us '
+            f'{bench_copy(data) * 1e6:>10.2f}us'
+        )
+
+
+if __name__ == '__main__':
+    main()
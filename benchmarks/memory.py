@@ -0,0 +1,153 @@
+
+import argparse
+import asyncio
+import base64
+import json
+import subprocess
+import sys
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+from benchmarks.conversion import FINAL_STATES, STARTUP_TIMEOUT, STATE_TIMEOUT, SPEED
+from benchmarks.conversion import StateFollower, get_process_stats, request_state, start_server, stop_server
+from benchmarks.conversion import wait_server
+from benchmarks.firmwareimage import make_image
+
+
+# Runs full simulated sessions (conversion with backup, download of the backup, flashing) while a few clients poll the
+# status, the way browsers do, and fails if the server's memory goes over budget. The images are built under QEMU with
+# 256MB and real targets share their 512MB with hostapd, dnsmasq, mosquitto and esptool, so the budget is tight.
+PORT = 8883
+ITERATIONS = 3
+POLLERS = 4
+POLL_INTERVAL = 0.2
+
+# tuya-convert refuses images larger than this
+FIRMWARE_SIZE = 512 * 1024
+
+# Budgets, in MB, for the peak RSS of the server process and for the peak of Python allocations (with tracemalloc);
+# measured peaks are about 36MB and 17MB on x86_64
+RSS_BUDGET = 48
+TRACED_BUDGET = 24
+
+
+async def poll_status(port: int, stop_event: asyncio.Event) -> None:
+    while not stop_event.is_set():
+        try:
+            await AsyncHTTPClient().fetch(f'http://127.0.0.1:{port}/status')
+
+        except (OSError, HTTPClientError):
+            pass
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), POLL_INTERVAL)
+
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_step(port: int, follower: StateFollower, state: str, params: Dict[str, Any]) -> str:
+    position = follower.get_position()
+    await request_state(port, state, params)
+    seen = await follower.wait(position, FINAL_STATES[state], STATE_TIMEOUT)
+
+    return seen[-1][0]
+
+
+async def run_session(port: int, server: subprocess.Popen, iterations: int) -> Tuple[Dict[str, Any], int]:
+    # Returns the memory usage reported by the server, along with its peak RSS
+    firmware = base64.urlsafe_b64encode(make_image(FIRMWARE_SIZE)).decode()
+
+    await wait_server(port)
+    follower = StateFollower(port)
+    follower.start()
+    await follower.wait(0, {'ready'}, STARTUP_TIMEOUT)
+
+    stop_event = asyncio.Event()
+    pollers = [asyncio.create_task(poll_status(port, stop_event)) for _ in range(POLLERS)]
+
+    try:
+        for _ in range(iterations):
+            final_state = await run_step(port, follower, 'converting', {'download_backup': True})
+            if final_state != 'converted':
+                raise Exception(f'Conversion ended in state {final_state}')
+
+            await AsyncHTTPClient().fetch(f'http://127.0.0.1:{port}/firmware/original.bin')
+
+            final_state = await run_step(port, follower, 'flashing', {'firmware': firmware, 'patch_header': True})
+            if final_state != 'flashed':
+                raise Exception(f'Flashing ended in state {final_state}')
+
+        usage = json.loads((await AsyncHTTPClient().fetch(f'http://127.0.0.1:{port}/memory')).body)
+        _, _, peak_rss = get_process_stats(server.pid)
+
+    finally:
+        stop_event.set()
+        await asyncio.gather(*pollers)
+        server.terminate()
+        await follower.stop()
+
+    return usage, peak_rss
+
+
+def format_mb(value: Optional[float]) -> str:
+    return f'{value / 1048576:>8.2f}MB' if value is not None else f'{"-":>10}'
+
+
+def print_samples(samples: List[Dict[str, Any]]) -> None:
+    print(f'{"from":>18} {"to":>18} {"rss":>10} {"peak rss":>10} {"traced":>10} {"peak":>10}')
+    for sample in samples:
+        print(
+            f'{sample["from_state"]:>18} {sample["to_state"]:>18} '
+            f'{format_mb(sample["rss"])} {format_mb(sample["peak_rss"])} '
+            f'{format_mb(sample.get("traced"))} {format_mb(sample.get("traced_peak"))}'
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Memory budget check over full simulated sessions')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--speed', type=float, default=SPEED, help='factor to speed up recorded timing by')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--budget', type=float, default=RSS_BUDGET, help='peak RSS budget, in MB')
+    parser.add_argument('--tracemalloc', action='store_true', help='also trace Python allocations in the server')
+    parser.add_argument('--traced-budget', type=float, default=TRACED_BUDGET, help='peak traced budget, in MB')
+    args = parser.parse_args()
+
+    print(f'iterations: {args.iterations}, firmware size: {FIRMWARE_SIZE // 1024}KB, pollers: {POLLERS}')
+
+    # Tracing allocations costs memory of its own, so RSS is only meaningful without it
+    extra_env = {'PYTHONTRACEMALLOC': '1'} if args.tracemalloc else {}
+    server, tc_dir = start_server(args.port, 'conversion.jsonl', args.speed, extra_env)
+
+    try:
+        usage, peak_rss = asyncio.run(run_session(args.port, server, args.iterations))
+
+    finally:
+        stop_server(server, tc_dir)
+
+    print_samples(usage['samples'])
+
+    failures = []
+    if not args.tracemalloc:
+        print(f'peak rss: {peak_rss / 1048576:.1f}MB (budget {args.budget:.1f}MB)')
+        if peak_rss > args.budget * 1048576:
+            failures.append('peak rss')
+
+    else:
+        traced_peak = max([s['traced_peak'] for s in usage['samples']] + [usage['traced_peak']])
+        print(f'peak traced: {traced_peak / 1048576:.1f}MB (budget {args.traced_budget:.1f}MB)')
+        if traced_peak > args.traced_budget * 1048576:
+            failures.append('peak traced')
+
+    if failures:
+        print(f'over budget: {", ".join(failures)}')
+        sys.exit(1)
+
+    print('within budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+
+import json
+import os
+import re
+import timeit
+
+from typing import List, Optional
+
+from pexpect.expect import Expecter, searcher_re
+from pexpect.spawnbase import SpawnBase
+
+from tcfrontend.outputparser import OutputParser
+from tcfrontend.tccontrol import TCProcess
+
+
+TRANSCRIPTS_DIR = os.path.join(os.path.dirname(__file__), 'transcripts')
+NUMBER = 100
+REPEAT = 5
+
+# The patterns the sequential expect() chain used to wait for, in order
+SEQUENTIAL_PATTERNS = [
+    rb'Press [^\s]+ to continue',
+    rb"curl: Saved to filename '([a-zA-Z0-9-]+.bin)'",
+    rb'ChipID: (.*?)\n',
+    rb'MAC: ([a-fA-F0-9:]+)',
+    rb'FlashMode: (\d+)M ([A-Z]+) @ (\d+)MHz',
+    rb'FlashChipId: (\d+)',
+    rb'Ready to flash third party firmware!',
+    rb'Please select 0-\d:\s*',
+    rb'This is the point of no return \[y/N\]\s+',
+    rb'successfully in \d+ms, rebooting\.\.\.',
+    rb'flash another device\? \[y/N\]\s*'
+]
+
+
+def load_transcript(name: str) -> List[bytes]:
+    with open(os.path.join(TRANSCRIPTS_DIR, name), 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    return [r['output'].encode() for r in records if 'output' in r]
+
+
+def rechunk(chunks: List[bytes], size: int) -> List[bytes]:
+    data = b''.join(chunks)
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def bench_parser(chunks: List[bytes]) -> float:
+    def run() -> None:
+        parser = OutputParser(TCProcess.OUTPUT_MARKERS)
+        for chunk in chunks:
+            parser.feed(chunk)
+
+    return min(timeit.repeat(run, number=NUMBER, repeat=REPEAT)) / NUMBER
+
+
+def reorder(chunks: List[bytes]) -> List[bytes]:
+    # Device info lines in a different order, as printed by other intermediate firmware versions
+    data = b''.join(chunks)
+    lines = data.split(b'\r\n')
+    info = [i for i, line in enumerate(lines) if line.startswith((b'ChipID:', b'MAC:', b'FlashMode:', b'FlashChipId:'))]
+    for i, j in zip(info, reversed(info)):
+        if i >= j:
+            break
+
+        lines[i], lines[j] = lines[j], lines[i]
+
+    return [b'\r\n'.join(lines)]
+
+
+def bench_sequential(chunks: List[bytes]) -> Optional[float]:
+    # Feeds pexpect's own expect machinery, one pattern after another, the way TCProcess used to call expect()
+    def run() -> None:
+        spawn = SpawnBase()
+        remaining = iter(chunks)
+        for pattern in SEQUENTIAL_PATTERNS:
+            expecter = Expecter(spawn, searcher_re([re.compile(pattern)]))
+            index = expecter.existing_data()
+            while index is None:
+                index = expecter.new_data(next(remaining))
+
+    try:
+        run()
+
+    except StopIteration:
+        return None  # Would have waited for a line that had already gone by
+
+    return min(timeit.repeat(run, number=NUMBER, repeat=REPEAT)) / NUMBER
+
+
+def check_parser(chunks: List[bytes]) -> None:
+    found = []
+    parser = OutputParser(TCProcess.OUTPUT_MARKERS, lambda name, groups: found.append(name))
+    for chunk in chunks:
+        parser.feed(chunk)
+
+    expected = [name for name, _, _ in TCProcess.OUTPUT_MARKERS]
+    if sorted(found) != sorted(expected):
+        raise Exception(f'Parser found markers {found}, expected {expected}')
+
+
+def main() -> None:
+    chunks = load_transcript('conversion.jsonl')
+    size = sum(len(c) for c in chunks)
+    variants = [
+        ('recorded', chunks),
+        ('burst', [b''.join(chunks)]),
+        ('64 bytes', rechunk(chunks, 64)),
+        ('1 byte', rechunk(chunks, 1)),
+        ('reordered', reorder(chunks))
+    ]
+
+    print(f'transcript: {size} bytes')
+    print(f'{"chunks":>20} {"parser":>12} {"pexpect":>12}')
+    for name, variant in variants:
+        check_parser(variant)
+
+        parser = bench_parser(variant)
+        sequential = bench_sequential(variant)
+        sequential = f'{sequential * 1e6:10.1f}us' if sequential is not None else f'{"stalls":>12}'
+        print(f'{f"{name} ({len(variant)})":>20} {parser * 1e6:10.1f}us {sequential}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+
+# Replays a recorded tuya-convert transcript on the terminal it's run on, so that TCProcess can be exercised without a
+# Wi-Fi adapter and a device. Runs in tuya-convert's dir, like the real start_flash.sh, and is configured by:
+#   TC_SIM_TRANSCRIPT: transcript file (default: conversion.jsonl from benchmarks/transcripts)
+#   TC_SIM_SPEED: factor to speed up the recorded timing by (default: 1)
+#
+# Transcripts are JSON lines, each record being one of:
+#   {"delay": 0.5, "output": "..."}: output, after the given delay in seconds
+#   {"input": "y", "goto": {"q": "quit"}}: waits for input (a line, if the recorded input is a newline, or as many
+#       characters as were recorded); may jump to a label, depending on the input
+#   {"label": "pairing"}, {"goto": "pairing"}: labels and unconditional jumps
+#   {"save_backup": "firmware-1234ab.bin", "size": 1048576}: writes a random original firmware backup
+# Records with "backup": true are only replayed when the backup hasn't been skipped.
+
+import json
+import os
+import sys
+import termios
+import time
+
+
+TRANSCRIPT = os.environ.get(
+    'TC_SIM_TRANSCRIPT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transcripts', 'conversion.jsonl')
+)
+SPEED = float(os.environ.get('TC_SIM_SPEED', '1'))
+SKIP_BACKUP_FLAG_FILE = '_skip_backup'
+BACKUPS_DIR = 'backups'
+
+
+def load(path):
+    with open(path, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    labels = {r['label']: i for i, r in enumerate(records) if 'label' in r}
+
+    return records, labels
+
+
+def read_input(expected):
+    # Input is echoed by the terminal, just like it is for tuya-convert's read builtin
+    if expected == '\n':
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = os.read(0, 1)
+            if not chunk:
+                sys.exit(1)
+
+            data += chunk
+
+        return data.decode()
+
+    data = b''
+    while len(data) < len(expected):
+        chunk = os.read(0, len(expected) - len(data))
+        if not chunk:
+            sys.exit(1)
+
+        data += chunk
+
+    return data.decode(errors='replace')
+
+
+def save_backup(filename, size):
+    backup_dir = os.path.join(BACKUPS_DIR, time.strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(backup_dir, exist_ok=True)
+    with open(os.path.join(backup_dir, filename), 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def main():
+    records, labels = load(TRANSCRIPT)
+
+    # Single characters are read without waiting for a newline, but still echoed; output was recorded as it came out of
+    # the terminal, so it's not processed again
+    if os.isatty(0):
+        attrs = termios.tcgetattr(0)
+        attrs[1] &= ~termios.OPOST
+        attrs[3] &= ~termios.ICANON
+        attrs[6][termios.VMIN] = 1
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(0, termios.TCSANOW, attrs)
+
+    i = 0
+    while i < len(records):
+        record = records[i]
+        i += 1
+
+        if record.get('backup') and os.path.exists(SKIP_BACKUP_FLAG_FILE):
+            continue
+
+        if 'output' in record:
+            time.sleep(record['delay'] / SPEED)
+            os.write(1, record['output'].encode())
+
+        elif 'input' in record:
+            data = read_input(record['input'])
+            label = record.get('goto', {}).get(data)
+            if label is not None:
+                i = labels[label]
+
+        elif 'goto' in record:
+            i = labels[record['goto']]
+
+        elif 'save_backup' in record:
+            if not os.path.exists(SKIP_BACKUP_FLAG_FILE):
+                save_backup(record['save_backup'], record['size'])
+
+
+if __name__ == '__main__':
+    main()
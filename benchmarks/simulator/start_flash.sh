@@ -0,0 +1,4 @@
+#!/bin/bash
+
+# Stand-in for tuya-convert's start_flash.sh, replaying a recorded transcript; see replay.py
+exec python3 "$(dirname "$0")/replay.py" "$@"
@@ -0,0 +1,297 @@
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.web import Application, RequestHandler
+
+from benchmarks.conversion import get_process_stats, request_state, start_server, stop_server, wait_server
+from benchmarks.firmwareimage import make_image
+
+
+# Several clients hammering the web server at once, the way phones and laptops connected to the AP poll the status and
+# load the page assets. The server runs in its own process, brought to the converted state through the tuya-convert
+# simulator, so that the original firmware backup can be served; firmware proxy requests go to a local origin.
+PORT = 8881
+ORIGIN_PORT = 8882
+CONCURRENCY = 8
+DURATION = 5
+FIRMWARE_SIZE = 300 * 1024
+STATE_TIMEOUT = 60
+BASELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Allowed deviation from the baseline before a result counts as a regression
+TOLERANCE = 0.2
+
+# (name, method, path, headers, body, expected status); paths and headers may refer to values obtained at run time
+SCENARIOS = [
+    ('status', 'GET', '/status', {}, b'', 200),
+    ('status patch', 'PATCH', '/status', {'Content-Type': 'application/json'}, b'{"state": "converted"}', 200),
+    ('main page', 'GET', '/', {'Accept-Encoding': 'gzip, deflate, br'}, b'', 200),
+    ('main.js', 'GET', '/static/main.js', {'Accept-Encoding': 'gzip, deflate, br'}, b'', 200),
+    ('icons.svg', 'GET', '/static/icons.svg', {'Accept-Encoding': 'gzip, deflate, br'}, b'', 200),
+    ('original.bin', 'GET', '/firmware/original.bin', {}, b'', 200),
+    ('original.bin 304', 'GET', '/firmware/original.bin', {'If-None-Match': '"{sha256}"'}, b'', 304),
+    ('proxy', 'GET', '/firmware/proxy?url=http://127.0.0.1:{origin_port}/firmware.bin', {}, b'', 200)
+]
+
+
+class OriginFirmwareHandler(RequestHandler):
+    # Tornado adds an ETag and answers revalidation requests with 304, like a typical origin server would
+    def initialize(self, firmware: bytes) -> None:
+        self._firmware = firmware
+
+    def get(self) -> None:
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.finish(self._firmware)
+
+
+class Connection:
+    # Minimal HTTP/1.1 client, keeping its connection alive between requests like a browser does
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._reader = reader
+        self._writer = writer
+        self.closed = False
+
+    @classmethod
+    async def open(cls, port: int) -> 'Connection':
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        return cls(reader, writer)
+
+    def close(self) -> None:
+        self._writer.close()
+        self.closed = True
+
+    async def request(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, int]:
+        # Returns the status code and the size of the body
+        lines = [f'{method} {path} HTTP/1.1', 'Host: 127.0.0.1', f'Content-Length: {len(body)}']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+
+        code = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            name, value = line.decode('latin-1').split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+
+        size = 0
+        if method == 'HEAD' or code in (204, 304):
+            pass
+
+        elif 'content-length' in response_headers:
+            size = int(response_headers['content-length'])
+            await self._reader.readexactly(size)
+
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int((await self._reader.readline()).split(b';')[0], 16)
+                await self._reader.readexactly(chunk_size + 2)
+                size += chunk_size
+                if not chunk_size:
+                    break
+
+        else:
+            size = len(await self._reader.read())
+            response_headers['connection'] = 'close'
+
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+
+        return code, size
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def run_scenario(
+    port: int,
+    server_pid: int,
+    scenario: Tuple[str, str, str, Dict[str, str], bytes, int],
+    values: Dict[str, Any],
+    concurrency: int,
+    duration: float
+) -> Dict[str, float]:
+    name, method, path, headers, body, expected_code = scenario
+    path = path.format(**values)
+    headers = {k: v.format(**values) for k, v in headers.items()}
+
+    latencies: List[float] = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def worker() -> None:
+        nonlocal errors
+
+        connection: Optional[Connection] = None
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                if connection is None:
+                    connection = await Connection.open(port)
+
+                code, _ = await connection.request(method, path, headers, body)
+
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                if connection:
+                    connection.close()
+                    connection = None
+
+                continue
+
+            latencies.append(time.monotonic() - start)
+            if code != expected_code:
+                errors += 1
+
+            if connection.closed:
+                connection = None
+
+        if connection:
+            connection.close()
+
+    start_cpu, _, _ = get_process_stats(server_pid)
+    start = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.monotonic() - start
+    cpu, rss, _ = get_process_stats(server_pid)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5) if latencies else 0,
+        'p99': percentile(latencies, 0.99) if latencies else 0,
+        'cpu_per_request': (cpu - start_cpu) / len(latencies) if latencies else 0,
+        'rss': rss
+    }
+
+
+def check_results(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float
+) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f'{name}: throughput {result["throughput"]:.1f}/s, baseline {base["throughput"]:.1f}/s')
+
+        for key in ('p50', 'p99'):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{name}: {key} {result[key] * 1e3:.2f}ms, baseline {base[key] * 1e3:.2f}ms')
+
+        if result['rss'] > base['rss'] * (1 + tolerance):
+            regressions.append(f'{name}: rss {result["rss"] / 1048576:.1f}MB, baseline {base["rss"] / 1048576:.1f}MB')
+
+        if result['errors']:
+            regressions.append(f'{name}: {result["errors"]} errors')
+
+    return regressions
+
+
+async def run(port: int, server_pid: int, concurrency: int, duration: float) -> Dict[str, Dict[str, float]]:
+    origin = Application([(r'/firmware.bin', OriginFirmwareHandler, {'firmware': bytes(make_image(FIRMWARE_SIZE))})])
+    origin_server = origin.listen(ORIGIN_PORT, address='127.0.0.1')
+
+    # Backup is only served once a conversion has completed
+    await wait_server(port)
+    await request_state(port, 'converting', {'download_backup': True})
+    deadline = time.monotonic() + STATE_TIMEOUT
+    while True:
+        status = json.loads((await AsyncHTTPClient().fetch(f'http://127.0.0.1:{port}/status')).body)
+        if status['state'] not in ('ready', 'converting') or time.monotonic() > deadline:
+            break
+
+        await asyncio.sleep(0.1)
+
+    if status['state'] != 'converted':
+        raise Exception(f'Conversion ended in state {status["state"]}')
+
+    values = {'sha256': status['params']['original_firmware_sha256'], 'origin_port': ORIGIN_PORT}
+
+    results = {}
+    print(
+        f'{"scenario":>18} {"requests":>9} {"errors":>7} {"req/s":>9} {"p50":>9} {"p99":>9} {"cpu/req":>9} {"rss":>8}'
+    )
+    for scenario in SCENARIOS:
+        result = results[scenario[0]] = await run_scenario(port, server_pid, scenario, values, concurrency, duration)
+        print(
+            f'{scenario[0]:>18} {result["requests"]:>9} {result["errors"]:>7} {result["throughput"]:>9.1f} '
+            f'{result["p50"] * 1e3:>7.2f}ms {result["p99"] * 1e3:>7.2f}ms '
+            f'{result["cpu_per_request"] * 1e3:>7.3f}ms {result["rss"] / 1048576:>6.1f}MB'
+        )
+
+    origin_server.stop()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='HTTP load benchmark of the web server')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds per scenario')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--baseline', default=os.path.join(BASELINES_DIR, f'webserver-{platform.machine()}.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='save results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='fail if results regress past the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    print(f'concurrency: {args.concurrency}, duration: {args.duration}s per scenario')
+
+    server, tc_dir = start_server(args.port, 'conversion.jsonl', speed=100)
+
+    try:
+        results = asyncio.run(run(args.port, server.pid, args.concurrency, args.duration))
+        _, _, peak_rss = get_process_stats(server.pid)
+
+    finally:
+        stop_server(server, tc_dir)
+
+    print(f'peak rss: {peak_rss / 1048576:.1f}MB')
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        print(f'baseline saved to {args.baseline}')
+
+    if args.check:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        regressions = check_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}')
+
+        if regressions:
+            sys.exit(1)
+
+        print('no regressions')
+
+
+if __name__ == '__main__':
+    main()
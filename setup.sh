@@ -36,6 +36,9 @@ sed -ri 's/read -p "Do you want to continue anyway.*//' tuya-convert/start_flash
 echo " * installing pexpect python package"
 pip3 install pexpect==4.8.0
 
+echo " * installing brotli python package"
+apt-get install -y python3-brotli
+
 echo " * disabling dnsmasq service"
 rm -f /etc/systemd/system/multi-user.target.wants/dnsmasq.service
 
@@ -69,6 +72,8 @@ After=network-online.target
 
 [Service]
 Type=simple
+# Set a token here to enable the /debug profiling endpoints
+#Environment=TCFRONTEND_DEBUG_TOKEN=
 ExecStart=/root/tcfrontend/tcfrontend.sh
 
 [Install]
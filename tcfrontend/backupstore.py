@@ -0,0 +1,193 @@
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from tcfrontend.jsonindex import JSONIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackupStore:
+    # Backups are stored once per content, named by their SHA-256; all but the most recent ones are gzipped. The index
+    # is a JSON lines file, appended to as backups are added and only rewritten when entries are dropped. Methods may
+    # be called from I/O threads.
+    INDEX_FILE = 'index.jsonl'
+    MAX_ENTRIES = 500
+    MAX_SIZE = 64 * 1024 * 1024
+    UNCOMPRESSED_COUNT = 5
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, store_dir: str) -> None:
+        self._dir = store_dir
+        self._index = JSONIndex(os.path.join(store_dir, self.INDEX_FILE), lines=True)
+        self._lock = threading.Lock()
+
+    def _get_plain_path(self, sha256: str) -> str:
+        return os.path.join(self._dir, f'{sha256}.bin')
+
+    def _get_compressed_path(self, sha256: str) -> str:
+        return os.path.join(self._dir, f'{sha256}.bin.gz')
+
+    def _get_blob_size(self, sha256: str) -> int:
+        for path in (self._get_plain_path(sha256), self._get_compressed_path(sha256)):
+            try:
+                return os.path.getsize(path)
+
+            except FileNotFoundError:
+                pass
+
+        return 0
+
+    def _compress(self, sha256: str) -> None:
+        path = self._get_plain_path(sha256)
+        if not os.path.exists(path):
+            return
+
+        logger.debug('compressing backup %s', sha256)
+
+        tmp_file = f'{self._get_compressed_path(sha256)}.tmp'
+        with open(path, 'rb') as src, gzip.open(tmp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, self.CHUNK_SIZE)
+
+        os.replace(tmp_file, self._get_compressed_path(sha256))
+        os.remove(path)
+
+    def _remove_compressed(self, sha256: str) -> None:
+        try:
+            os.remove(self._get_compressed_path(sha256))
+
+        except FileNotFoundError:
+            pass
+
+    def _remove_blob(self, sha256: str) -> None:
+        try:
+            os.remove(self._get_plain_path(sha256))
+
+        except FileNotFoundError:
+            pass
+
+        self._remove_compressed(sha256)
+
+    def _maintain(self) -> None:
+        entries = self._index.load()
+        ids = list(entries)
+
+        recent = {entries[i]['sha256'] for i in ids[-self.UNCOMPRESSED_COUNT:]}
+        for sha256 in {e['sha256'] for e in entries.values()} - recent:
+            self._compress(sha256)
+
+        # Drop oldest entries until the store fits, but always keep the most recent one
+        blob_sizes = {e['sha256']: self._get_blob_size(e['sha256']) for e in entries.values()}
+        total_size = sum(blob_sizes.values())
+        removed = False
+
+        for id_ in ids[:-1]:
+            if len(entries) <= self.MAX_ENTRIES and total_size <= self.MAX_SIZE:
+                break
+
+            sha256 = entries.pop(id_)['sha256']
+            removed = True
+            logger.debug('dropping backup %s', id_)
+
+            if any(e['sha256'] == sha256 for e in entries.values()):
+                continue  # Content still referenced by another entry
+
+            total_size -= blob_sizes[sha256]
+            self._remove_blob(sha256)
+
+        if removed:
+            self._index.save()
+
+    def add(self, path: str, mac: Optional[str], chip_id: Optional[str]) -> Dict[str, Any]:
+        with self._lock:
+            return self._add(path, mac, chip_id)
+
+    def _add(self, path: str, mac: Optional[str], chip_id: Optional[str]) -> Dict[str, Any]:
+        os.makedirs(self._dir, exist_ok=True)
+
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                size += len(chunk)
+
+        sha256 = sha256.hexdigest()
+
+        # Move the backup out of the directory tuya-convert put it in, so that the backups dir doesn't keep growing;
+        # being the most recent backup, it's stored uncompressed
+        if os.path.exists(self._get_plain_path(sha256)):
+            os.remove(path)
+
+        else:
+            os.replace(path, self._get_plain_path(sha256))
+            self._remove_compressed(sha256)
+
+        try:
+            os.rmdir(os.path.dirname(path))
+
+        except OSError:
+            pass  # Not empty
+
+        entries = self._index.load()
+        timestamp = time.time()
+        id_ = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp)), chip_id or 'unknown')
+        if id_ in entries:
+            id_ = f'{id_}-{sha256[:8]}'
+
+        entry = {
+            'id': id_,
+            'timestamp': timestamp,
+            'mac': mac,
+            'chip_id': chip_id,
+            'filename': os.path.basename(path),
+            'sha256': sha256,
+            'size': size
+        }
+
+        logger.debug('adding backup %s (%s)', id_, sha256)
+
+        entries[id_] = entry
+        self._index.append(entry)
+        self._maintain()
+
+        return entry
+
+    def get_entries(self, mac: Optional[str] = None, chip_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = list(self._index.load().values())
+
+        if mac is not None:
+            entries = [e for e in entries if (e['mac'] or '').lower() == mac.lower()]
+
+        if chip_id is not None:
+            entries = [e for e in entries if e['chip_id'] == chip_id]
+
+        return list(entries)
+
+    def get_entry(self, id_: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._index.load().get(id_)
+
+    def get_path(self, entry: Dict[str, Any]) -> Optional[str]:
+        # Only recent backups are available as plain files
+        path = self._get_plain_path(entry['sha256'])
+
+        return path if os.path.exists(path) else None
+
+    def open(self, entry: Dict[str, Any]) -> BinaryIO:
+        sha256 = entry['sha256']
+
+        try:
+            return open(self._get_plain_path(sha256), 'rb')
+
+        except FileNotFoundError:
+            return gzip.open(self._get_compressed_path(sha256), 'rb')
@@ -0,0 +1,178 @@
+
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from typing import Dict, List, Optional
+
+from tornado.log import access_log
+from tornado.web import RequestHandler
+
+
+# Debug endpoints are only available when a token is configured, e.g. through the systemd unit's environment; requests
+# must present it as a bearer token
+TOKEN = os.environ.get('TCFRONTEND_DEBUG_TOKEN') or None
+
+MAX_PROFILE_DURATION = 300
+DEFAULT_PROFILE_DURATION = 10
+SAMPLE_INTERVAL = 0.005
+DEFAULT_TOP = 50
+TRACEMALLOC_FRAMES = 10
+
+logger = logging.getLogger(__name__)
+
+_profiling: bool = False
+_handler_stats: Dict[str, List[float]] = {}
+
+
+def is_enabled() -> bool:
+    return TOKEN is not None
+
+
+def check_token(value: Optional[str]) -> bool:
+    return value is not None and hmac.compare_digest(value.encode(), TOKEN.encode())
+
+
+def log_request(handler: RequestHandler) -> None:
+    # Replaces Tornado's own request logging while debugging is enabled, recording handler timings along the way
+    duration = handler.request.request_time()
+    stats = _handler_stats.setdefault(type(handler).__name__, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += duration
+    stats[2] = max(stats[2], duration)
+
+    status = handler.get_status()
+    if status < 400:
+        log_method = access_log.info
+
+    elif status < 500:
+        log_method = access_log.warning
+
+    else:
+        log_method = access_log.error
+
+    log_method('%d %s %.2fms', status, handler._request_summary(), duration * 1000)
+
+
+def format_handler_stats() -> str:
+    lines = [f'{"handler":<32} {"count":>8} {"mean":>10} {"max":>10} {"total":>10}']
+    for name, (count, total, max_) in sorted(_handler_stats.items(), key=lambda i: -i[1][1]):
+        lines.append(f'{name:<32} {count:>8} {total / count * 1000:>8.2f}ms {max_ * 1000:>8.2f}ms {total:>9.3f}s')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _sample_stacks(thread_id: int, duration: float) -> Dict[str, int]:
+    counts = {}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})')
+            frame = frame.f_back
+
+        if names:
+            stack = ';'.join(reversed(names))
+            counts[stack] = counts.get(stack, 0) + 1
+
+        time.sleep(SAMPLE_INTERVAL)
+
+    return counts
+
+
+def is_profiling() -> bool:
+    return _profiling
+
+
+async def profile(duration: float, mode: str, sort: str, top: int) -> str:
+    global _profiling
+
+    assert not _profiling
+
+    _profiling = True
+    logger.info('profiling (%s) for %s seconds', mode, duration)
+
+    try:
+        if mode == 'sample':
+            # Stacks of the event loop thread are sampled from another thread; output is in collapsed stack format, as
+            # used by flame graph tools
+            counts = await asyncio.get_event_loop().run_in_executor(
+                None, _sample_stacks, threading.get_ident(), duration
+            )
+
+            return ''.join(f'{stack} {count}\n' for stack, count in sorted(counts.items()))
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        try:
+            await asyncio.sleep(duration)
+
+        finally:
+            profiler.disable()
+
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(top)
+
+        return output.getvalue()
+
+    finally:
+        _profiling = False
+
+
+def start_tracing() -> None:
+    if not tracemalloc.is_tracing():
+        logger.info('starting memory allocation tracing')
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+
+def stop_tracing() -> None:
+    if tracemalloc.is_tracing():
+        logger.info('stopping memory allocation tracing')
+        tracemalloc.stop()
+
+
+def format_top_allocations(key_type: str, top: int) -> str:
+    if not tracemalloc.is_tracing():
+        return 'memory allocation tracing not started\n'
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+
+    lines = [f'traced: {current} bytes, peak: {peak} bytes', '']
+    limit = TRACEMALLOC_FRAMES if key_type == 'traceback' else 1
+    for stat in snapshot.statistics(key_type)[:top]:
+        lines.append(f'{stat.size:>10} bytes {stat.count:>8} blocks')
+        lines.extend(f'    {line}' for line in stat.traceback.format(limit=limit))
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_tasks(named_tasks: Dict[str, Optional[asyncio.Task]]) -> str:
+    names = {id(task): name for name, task in named_tasks.items() if task is not None}
+    output = io.StringIO()
+
+    for name, task in sorted(named_tasks.items()):
+        output.write(f'{name}: {"running" if task is not None and not task.done() else "none"}\n')
+
+    output.write('\n')
+
+    for task in asyncio.all_tasks():
+        name = names.get(id(task))
+        output.write(f'{name + ": " if name else ""}{task!r}\n')
+        task.print_stack(limit=5, file=output)
+        output.write('\n')
+
+    return output.getvalue()
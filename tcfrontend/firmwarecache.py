@@ -0,0 +1,142 @@
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from typing import Any, BinaryIO, Dict, Optional
+
+from tcfrontend.jsonindex import JSONIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class FirmwareCache:
+    # Firmware files downloaded by URL, along with their ETag and Last-Modified, so that flashing a batch of devices
+    # from the same URL only takes revalidating the file. Files are stored once per content, named by their SHA-256,
+    # and the least recently used ones are evicted to keep the cache within its size. Methods may be called from I/O
+    # threads.
+    INDEX_FILE = 'index.json'
+    MAX_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, cache_dir: str) -> None:
+        self._dir = cache_dir
+        self._index = JSONIndex(os.path.join(cache_dir, self.INDEX_FILE))
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _get_blob_path(self, sha256: str) -> str:
+        return os.path.join(self._dir, f'{sha256}.bin')
+
+    def _evict(self) -> None:
+        index = self._index.load()
+        blob_sizes = {e['sha256']: e['size'] for e in index.values()}
+        total_size = sum(blob_sizes.values())
+
+        # Drop least recently used entries until the cache fits, but always keep the most recent one
+        urls = sorted(index, key=lambda u: index[u]['last_used'])
+        for url in urls[:-1]:
+            if total_size <= self.MAX_SIZE:
+                break
+
+            sha256 = index.pop(url)['sha256']
+            logger.debug('evicting %s from firmware cache', url)
+
+            if any(e['sha256'] == sha256 for e in index.values()):
+                continue  # Content still referenced by another URL
+
+            total_size -= blob_sizes[sha256]
+            self._remove_blob(sha256)
+
+    def _remove_blob(self, sha256: str) -> None:
+        try:
+            os.remove(self._get_blob_path(sha256))
+
+        except FileNotFoundError:
+            pass
+
+    def get_entry(self, url: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._index.load().get(url)
+
+        if entry is None or not os.path.isfile(self._get_blob_path(entry['sha256'])):
+            return None
+
+        return dict(entry)
+
+    def open_entry(self, url: str) -> BinaryIO:
+        # Cached file stays readable through the returned file object, even if evicted in the meantime
+        with self._lock:
+            entry = self._index.load()[url]
+            f = open(self._get_blob_path(entry['sha256']), 'rb')
+
+            entry['last_used'] = time.time()
+            self._index.save()
+            self._hits += 1
+
+        return f
+
+    def create_file(self) -> BinaryIO:
+        # Temporary file to download into, to be either added or discarded
+        os.makedirs(self._dir, exist_ok=True)
+
+        with self._lock:
+            self._misses += 1
+
+        return tempfile.NamedTemporaryFile(dir=self._dir, suffix='.tmp', delete=False)
+
+    def add(self, url: str, f: BinaryIO, sha256: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        size = f.tell()
+        f.close()
+
+        with self._lock:
+            # Identical content downloaded from a different URL is stored only once
+            path = self._get_blob_path(sha256)
+            if os.path.exists(path):
+                os.remove(f.name)
+
+            else:
+                os.replace(f.name, path)
+
+            logger.debug('caching %s bytes from %s as %s', size, url, sha256)
+
+            # Content the URL used to have goes away, unless still referenced by another URL
+            index = self._index.load()
+            old_sha256 = index.pop(url, {}).get('sha256', sha256)
+            if old_sha256 != sha256 and all(e['sha256'] != old_sha256 for e in index.values()):
+                self._remove_blob(old_sha256)
+
+            index[url] = {
+                'sha256': sha256,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'last_used': time.time()
+            }
+
+            self._evict()
+            self._index.save()
+
+    def discard_file(self, f: BinaryIO) -> None:
+        f.close()
+
+        try:
+            os.remove(f.name)
+
+        except FileNotFoundError:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            index = self._index.load()
+            blob_sizes = {e['sha256']: e['size'] for e in index.values()}
+
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'entries': len(index),
+                'size': sum(blob_sizes.values())
+            }
@@ -0,0 +1,287 @@
+
+import asyncio
+import hashlib
+import logging
+
+from typing import Any, Awaitable, BinaryIO, Dict, Optional
+
+from tornado import httputil
+from tornado import simple_httpclient
+from tornado.httpclient import HTTPClientError, HTTPRequest
+
+from tcfrontend import firmwareimage
+from tcfrontend.firmwarecache import FirmwareCache
+from tcfrontend.iothreads import run_io
+
+
+logger = logging.getLogger(__name__)
+
+
+class _StreamingHTTPConnection(simple_httpclient._HTTPConnection):
+    # Streaming callbacks may return an awaitable, which holds off reading the rest of the response until done, like
+    # data_received() of request handlers
+    def data_received(self, chunk: bytes) -> Optional[Awaitable[None]]:
+        if self.request.streaming_callback is None or self._should_follow_redirect():
+            return super().data_received(chunk)
+
+        return self.request.streaming_callback(chunk)
+
+
+class _StreamingHTTPClient(simple_httpclient.SimpleAsyncHTTPClient):
+    def _connection_class(self) -> type:
+        return _StreamingHTTPConnection
+
+
+class FirmwareDownload:
+    # Fetches a firmware file by URL, through the firmware cache: a cached copy is revalidated with the origin, and used
+    # if still current or if the origin can't be reached; otherwise the file is downloaded into the cache. Chunks are
+    # written out by I/O threads as they arrive and read() follows the file as it grows, so that memory usage depends
+    # neither on the file size nor on how fast the file is consumed.
+    MAX_SIZE = 4 * 1024 * 1024
+    TIMEOUT = 120
+    CHUNK_SIZE = 64 * 1024
+    # Chunks received but not yet written out; the download is held up while that many are waiting
+    MAX_PENDING_CHUNKS = 4
+
+    def __init__(self, url: str, cache: FirmwareCache) -> None:
+        self.url = url
+        self.content_length: Optional[int] = None
+        self.cached = False
+
+        self._cache = cache
+        self._code: Optional[int] = None
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+
+        self._chunks: asyncio.Queue = asyncio.Queue(maxsize=self.MAX_PENDING_CHUNKS)
+        self._received = 0
+        self._firmware_error: Optional[firmwareimage.FirmwareError] = None
+        self._file: Optional[BinaryIO] = None
+        self._sha256 = hashlib.sha256()
+        self._written = 0
+        self._reader: Optional[BinaryIO] = None
+        self._read = 0
+
+        self._fetch_task: Optional[asyncio.Task] = None
+        self._writing_task: Optional[asyncio.Task] = None
+        self._done = False
+        self._error: Optional[Exception] = None
+        self._closed = False
+        self._changed = asyncio.Event()
+
+    async def start(self) -> None:
+        # Returns as soon as the file is found in the cache or starts downloading; raises if neither
+        entry = await run_io(self._cache.get_entry, self.url)
+        self._fetch_task = asyncio.create_task(self._fetch(entry))
+
+        while self._writing_task is None and not self._done:
+            await self._changed.wait()
+
+        if self._error is not None and self._writing_task is None:
+            raise self._error
+
+    async def read(self) -> bytes:
+        # Returns the next chunk of the file, once written out; an empty chunk means the end of the file, while a failed
+        # download raises once everything written before the failure has been read
+        while self._read >= self._written:
+            if self._done:
+                if self._error is not None:
+                    raise self._error
+
+                return b''
+
+            await self._changed.wait()
+
+        chunk = await run_io(self._reader.read, min(self._written - self._read, self.CHUNK_SIZE))
+        self._read += len(chunk)
+
+        return chunk
+
+    def close(self) -> None:
+        # Gives up on the download if it's still in progress, e.g. as nobody reads the file anymore
+        self._closed = True
+        if self._done:
+            self._close_reader()
+
+    def _close_reader(self) -> None:
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _fetch(self, entry: Optional[Dict[str, Any]]) -> None:
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        http_client = _StreamingHTTPClient(force_instance=True, max_body_size=self.MAX_SIZE)
+        request = HTTPRequest(
+            self.url,
+            headers=headers,
+            header_callback=self._on_header,
+            streaming_callback=self._on_chunk,
+            request_timeout=self.TIMEOUT
+        )
+
+        error = None
+
+        try:
+            await http_client.fetch(request)
+
+        except Exception as e:
+            error = e
+
+        finally:
+            http_client.close()
+
+        try:
+            if self._writing_task is not None:
+                await self._finish_writing(error)
+
+            elif entry and isinstance(error, HTTPClientError) and error.code == 304:
+                logger.debug('using cached firmware file for %s', self.url)
+                await self._open_cached(entry)
+
+            elif entry and (not isinstance(error, HTTPClientError) or error.code >= 500):
+                # Origin is unreachable or failing
+                logger.warning('using possibly stale cached firmware file for %s: %s', self.url, error)
+                await self._open_cached(entry)
+
+            else:
+                raise error or Exception(f'Unexpected response {self._code} for {self.url}')
+
+        except Exception as e:
+            self._error = e
+
+        self._done = True
+        if self._closed:
+            self._close_reader()
+
+        self._notify()
+
+    async def _open_cached(self, entry: Dict[str, Any]) -> None:
+        self._reader = await run_io(self._cache.open_entry, self.url)
+        self.cached = True
+        self.content_length = entry['size']
+        self._written = entry['size']
+
+    def _on_header(self, line: str) -> None:
+        line = line.strip()
+        if self._code is None:
+            self._code = httputil.parse_response_start_line(line).code
+            return
+
+        if self._code != 200:
+            return  # Other responses are handled once the fetch completes
+
+        if line:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if name == 'content-length':
+                self.content_length = int(value)
+
+            elif name == 'etag':
+                self._etag = value
+
+            elif name == 'last-modified':
+                self._last_modified = value
+
+            return
+
+        # Empty line marks the end of the headers
+        self._writing_task = asyncio.create_task(self._write_chunks())
+        self._notify()
+
+    async def _on_chunk(self, chunk: bytes) -> None:
+        if self._writing_task is None:
+            return  # Body of an error response
+
+        if self._closed:
+            raise Exception('firmware download closed')
+
+        if self._firmware_error:
+            return
+
+        # Check the image header as soon as it arrives, so that nothing else gets cached or passed on; the rest of the
+        # file is ignored, and the error raised once the fetch completes
+        if not self._received:
+            try:
+                firmwareimage.parse_header(memoryview(chunk), partial=True)
+
+            except firmwareimage.FirmwareError as e:
+                self._firmware_error = e
+                return
+
+        self._received += len(chunk)
+        await self._chunks.put(chunk)
+
+    def _open_files(self) -> BinaryIO:
+        f = self._cache.create_file()
+        self._reader = open(f.name, 'rb')
+
+        return f
+
+    def _write_chunk(self, chunk: bytes) -> None:
+        # Flushed right away, as the reader only goes by what's been written
+        self._file.write(chunk)
+        self._file.flush()
+        self._sha256.update(chunk)
+
+    async def _write_chunks(self) -> None:
+        # Chunks keep being taken after a failure, so that the download isn't held up until it stops
+        error = None
+
+        try:
+            self._file = await run_io(self._open_files)
+
+        except Exception as e:
+            error = e
+            self._closed = True  # Stop downloading
+
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is None:
+                break
+
+            if error is not None:
+                continue
+
+            try:
+                await run_io(self._write_chunk, chunk)
+
+            except Exception as e:
+                error = e
+                self._closed = True
+                continue
+
+            self._written += len(chunk)
+            self._notify()
+
+        if error is not None:
+            raise error
+
+    async def _finish_writing(self, error: Optional[Exception]) -> None:
+        await self._chunks.put(None)
+        error = self._firmware_error or error
+
+        try:
+            await self._writing_task
+
+        except Exception as e:
+            error = error or e
+
+        if error is not None:
+            if self._file is not None:
+                await run_io(self._cache.discard_file, self._file)
+
+            raise error
+
+        logger.debug('downloaded %s bytes from %s', self._written, self.url)
+        await run_io(self._cache.add, self.url, self._file, self._sha256.hexdigest(), self._etag, self._last_modified)
@@ -0,0 +1,134 @@
+
+import hashlib
+import mmap
+import os
+
+from typing import Any, Dict, Optional, Tuple
+
+
+MAGIC = 0xE9
+HEADER_SIZE = 8
+SEGMENT_HEADER_SIZE = 8
+
+FLASH_MODES = {
+    'QIO': 0x0,
+    'QOUT': 0x1,
+    'DIO': 0x2,
+    'DOUT': 0x3
+}
+
+FLASH_SIZES = {  # MB
+    1: 0x2,
+    2: 0x3,
+    4: 0x4,
+    8: 0x8,
+    16: 0x9
+}
+
+FLASH_FREQS = {  # MHz
+    40: 0x0,
+    26: 0x1,
+    20: 0x2,
+    80: 0xF
+}
+
+_FLASH_MODES_REV = {v: k for k, v in FLASH_MODES.items()}
+_FLASH_SIZES_REV = {v: k for k, v in FLASH_SIZES.items()}
+_FLASH_FREQS_REV = {v: k for k, v in FLASH_FREQS.items()}
+
+
+class FirmwareError(Exception):
+    pass
+
+
+# Parses the ESP8266 image header and walks its segment headers, without copying any data. With `partial`, `data` is
+# just the beginning of the image and only the image header is parsed.
+def parse_header(data: memoryview, partial: bool = False) -> Dict[str, Any]:
+    if len(data) < HEADER_SIZE:
+        raise FirmwareError('Firmware header is truncated')
+
+    if data[0] != MAGIC:
+        raise FirmwareError('Firmware must start with magic byte')
+
+    segments = data[1]
+    flash_mode = _FLASH_MODES_REV.get(data[2])
+    if flash_mode is None:
+        raise FirmwareError(f'Unknown firmware flash mode 0x{data[2]:02X}')
+
+    header = {
+        'segments': segments,
+        'entry': int.from_bytes(data[4:8], 'little'),
+        'flash_mode': flash_mode,
+        'flash_size': _FLASH_SIZES_REV.get(data[3] >> 4),
+        'flash_freq': _FLASH_FREQS_REV.get(data[3] & 0x0F)
+    }
+
+    if partial:
+        return header
+
+    offset = HEADER_SIZE
+    for i in range(segments):
+        if offset + SEGMENT_HEADER_SIZE > len(data):
+            raise FirmwareError(f'Firmware segment {i} header is truncated')
+
+        offset += SEGMENT_HEADER_SIZE + int.from_bytes(data[offset + 4:offset + 8], 'little')
+        if offset > len(data):
+            raise FirmwareError(f'Firmware segment {i} is truncated')
+
+    return header
+
+
+# Parses the header of an image file and computes its SHA-256, mapping the file rather than reading it into memory
+def parse_file(path: str) -> Tuple[Dict[str, Any], str]:
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise FirmwareError('Firmware is empty')
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            data = memoryview(m)
+
+            try:
+                return parse_header(data), hashlib.sha256(data).hexdigest()
+
+            finally:
+                data.release()
+
+
+def check_flash_params(header: Dict[str, Any], flash_params: Dict[str, Any]) -> None:
+    mismatches = []
+    for name, value in _normalize_flash_params(flash_params).items():
+        if value is not None and header[name] != value:
+            mismatches.append(f'{name} is {header[name]} instead of {value}')
+
+    if mismatches:
+        raise FirmwareError(f'Firmware does not match device: {", ".join(mismatches)}')
+
+
+# Rewrites flash mode, size and frequency in the image header, in place
+def patch_flash_params(data: memoryview, flash_params: Dict[str, Any]) -> None:
+    flash_params = _normalize_flash_params(flash_params)
+
+    try:
+        if flash_params['flash_mode'] is not None:
+            data[2] = FLASH_MODES[flash_params['flash_mode']]
+
+        if flash_params['flash_size'] is not None:
+            data[3] = (FLASH_SIZES[flash_params['flash_size']] << 4) | (data[3] & 0x0F)
+
+        if flash_params['flash_freq'] is not None:
+            data[3] = (data[3] & 0xF0) | FLASH_FREQS[flash_params['flash_freq']]
+
+    except KeyError as e:
+        raise FirmwareError(f'Unsupported flash parameter value {e}') from e
+
+
+def _normalize_flash_params(flash_params: Dict[str, Any]) -> Dict[str, Optional[Any]]:
+    # Flash params may come from clients as strings
+    flash_size = flash_params.get('flash_size')
+    flash_freq = flash_params.get('flash_freq')
+
+    return {
+        'flash_mode': flash_params.get('flash_mode'),
+        'flash_size': int(flash_size) if flash_size is not None else None,
+        'flash_freq': int(flash_freq) if flash_freq is not None else None
+    }
@@ -0,0 +1,105 @@
+
+import logging
+import os
+import threading
+import time
+
+from typing import Any, Dict, List, Optional
+
+from tcfrontend import firmwareimage
+from tcfrontend.jsonindex import JSONIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class FirmwareLibrary:
+    # Firmware images kept on the device, so that they can be flashed over and over without being transferred again.
+    # Images are validated and their headers parsed once, when added; each is stored once per content, named by its
+    # SHA-256, and identified by a prefix of it. Methods may be called from I/O threads.
+    INDEX_FILE = 'index.json'
+    ID_LEN = 16
+    MAX_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, library_dir: str) -> None:
+        self._dir = library_dir
+        self._index = JSONIndex(os.path.join(library_dir, self.INDEX_FILE))
+        self._lock = threading.Lock()
+
+    def _get_blob_path(self, sha256: str) -> str:
+        return os.path.join(self._dir, f'{sha256}.bin')
+
+    def add(self, path: str, name: str, version: Optional[str]) -> Dict[str, Any]:
+        # Image file is moved into the library
+        with self._lock:
+            return self._add(path, name, version)
+
+    def _add(self, path: str, name: str, version: Optional[str]) -> Dict[str, Any]:
+        header, sha256 = firmwareimage.parse_file(path)
+        size = os.path.getsize(path)
+
+        entries = self._index.load()
+        total_size = sum(e['size'] for e in entries.values())
+        id_ = sha256[:self.ID_LEN]
+
+        if id_ not in entries and total_size + size > self.MAX_SIZE:
+            raise firmwareimage.FirmwareError('Firmware library is full')
+
+        os.makedirs(self._dir, exist_ok=True)
+
+        blob_path = self._get_blob_path(sha256)
+        if os.path.exists(blob_path):
+            os.remove(path)
+
+        else:
+            os.replace(path, blob_path)
+
+        # Adding the same image again just renames it
+        entry = {
+            'id': id_,
+            'name': name,
+            'version': version,
+            'size': size,
+            'sha256': sha256,
+            'timestamp': time.time(),
+            'segments': header['segments'],
+            'flash_mode': header['flash_mode'],
+            'flash_size': header['flash_size'],
+            'flash_freq': header['flash_freq']
+        }
+
+        logger.debug('adding firmware %s %s (%s)', name, version or '', sha256)
+
+        entries[id_] = entry
+        self._index.save()
+
+        return entry
+
+    def remove(self, id_: str) -> bool:
+        with self._lock:
+            entry = self._index.load().pop(id_, None)
+            if entry is None:
+                return False
+
+            logger.debug('removing firmware %s', id_)
+
+            self._index.save()
+
+            try:
+                os.remove(self._get_blob_path(entry['sha256']))
+
+            except FileNotFoundError:
+                pass
+
+            return True
+
+    def get_entries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return sorted(self._index.load().values(), key=lambda e: (e['name'], e['version'] or ''))
+
+    def get_entry(self, id_: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._index.load().get(id_)
+
+    def get_path(self, entry: Dict[str, Any]) -> str:
+        return self._get_blob_path(entry['sha256'])
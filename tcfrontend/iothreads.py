@@ -0,0 +1,23 @@
+
+import asyncio
+import concurrent.futures
+import functools
+
+from typing import Any, Callable, Optional, TypeVar
+
+
+# Blocking file system work is handed to a small pool of threads, so that it doesn't hold up the event loop
+IO_THREADS = 2
+
+T = TypeVar('T')
+
+_io_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+async def run_io(func: Callable[..., T], *args: Any) -> T:
+    global _io_executor
+
+    if _io_executor is None:
+        _io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='io')
+
+    return await asyncio.get_event_loop().run_in_executor(_io_executor, functools.partial(func, *args))
@@ -0,0 +1,76 @@
+
+import json
+import logging
+import os
+
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class JSONIndex:
+    # Entries kept in a JSON file, by key; loaded on first use and rewritten atomically, by way of a temporary file.
+    # With lines, the file holds one entry per line, keyed by its 'id', so that adding an entry only appends to it. Not
+    # locked: owners that are used from I/O threads hold their own lock around calls.
+
+    def __init__(self, path: str, lines: bool = False) -> None:
+        self._path = path
+        self._lines = lines
+        self._entries: Optional[Dict[str, Any]] = None
+
+    def load(self) -> Dict[str, Any]:
+        if self._entries is not None:
+            return self._entries
+
+        # Entries are kept in the order they were added, oldest first
+        self._entries = {}
+
+        try:
+            with open(self._path, 'r') as f:
+                if self._lines:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+
+                        except ValueError:
+                            logger.warning('skipping invalid line of %s', self._path)
+                            continue
+
+                        self._entries[entry['id']] = entry
+
+                else:
+                    self._entries = json.load(f)
+
+        except FileNotFoundError:
+            pass
+
+        except Exception:
+            logger.error('failed to load %s', self._path, exc_info=True)
+            self._entries = {}
+
+        return self._entries
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        # Entry must have been added to the loaded entries already
+        if not self._lines:
+            self.save()
+            return
+
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+        tmp_file = f'{self._path}.tmp'
+        with open(tmp_file, 'w') as f:
+            if self._lines:
+                for entry in self.load().values():
+                    f.write(json.dumps(entry) + '\n')
+
+            else:
+                json.dump(self.load(), f)
+
+        os.replace(tmp_file, self._path)
@@ -2,22 +2,33 @@
 import asyncio
 import fcntl
 import logging
+import logging.handlers
+import queue
 import socket
 import struct
 
 from tornado import httpserver
 
+from tcfrontend import metrics
 from tcfrontend import webserver
 from tcfrontend import states
+from tcfrontend import staticfiles
+from tcfrontend import tccontrol
 
 
 IFNAMES = ['eth0', 'wlan0']
 PORT = 80
 
 logger = None
+log_listener = None
 
 
 async def init():
+    metrics.init()
+
+    # Phase timeouts are needed as soon as the first tuya-convert process starts
+    await tccontrol.run_io(tccontrol.get_phase_durations().load)
+
     states.init()
 
 
@@ -32,8 +43,8 @@ def get_ip_address(ifname):
     )
 
 
-def main() -> None:
-    global logger
+def init_logging() -> None:
+    global log_listener
 
     logging.basicConfig(
         format='%(asctime)s: %(levelname)7s: [%(name)s] %(message)s',
@@ -41,11 +52,36 @@ def main() -> None:
         level=logging.DEBUG
     )
 
+    # Records are written out by a background thread, so that slow storage doesn't hold up the event loop
+    root_logger = logging.getLogger()
+    handlers = root_logger.handlers[:]
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def main() -> None:
+    global logger
+
+    init_logging()
+
     logging.getLogger('tornado').setLevel(logging.WARNING)
 
     logger = logging.getLogger('tcfrontend')
     logger.info('hello!')
 
+    try:
+        staticfiles.build()
+
+    # Precompressed files are only an optimization, the originals are served without them
+    except Exception:
+        logger.warning('could not precompress static files', exc_info=True)
+
     app = webserver.make_app()
 
     for ifname in IFNAMES:
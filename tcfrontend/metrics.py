@@ -0,0 +1,272 @@
+
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+
+# Durations range from milliseconds (parsing a line that has already arrived) to minutes (pairing, flashing)
+DEFAULT_BUCKETS = (0.01, 0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 180, 300)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LOOP_LAG_INTERVAL = 1
+
+# Event loop lag of at least this much means a callback kept the loop busy, and is logged along with the stack of the
+# callback, while it's still running; None disables the check. A watchdog thread pings the loop every fraction of it,
+# so that every block longer than SLOW_CALLBACK_DURATION * (1 + WATCHDOG_INTERVAL) is caught.
+SLOW_CALLBACK_DURATION = 0.1
+WATCHDOG_INTERVAL = 0.5
+
+# Memory is sampled at every state transition, so that growth can be traced back to a step of the session; only the
+# most recent samples are kept
+MEMORY_SAMPLES = 100
+
+logger = logging.getLogger(__name__)
+
+_metrics: List['Metric'] = []
+_loop_lag_task: Optional[asyncio.Task] = None
+_watchdog_thread: Optional[threading.Thread] = None
+_memory_samples: Deque[Dict[str, Any]] = collections.deque(maxlen=MEMORY_SAMPLES)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ','.join(
+        '{}="{}"'.format(n, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for n, v in zip(names, values)
+    )
+
+    return f'{{{labels}}}' if labels else ''
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help_: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_
+        self.labelnames = labelnames
+
+        _metrics.append(self)
+
+    def _get_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def collect(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.TYPE}'
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    # Value is either updated explicitly or, for metrics without labels, obtained from a function at collection time
+    def __init__(
+        self,
+        name: str,
+        help_: str,
+        labelnames: Tuple[str, ...] = (),
+        func: Optional[Callable[[], float]] = None
+    ) -> None:
+        super().__init__(name, help_, labelnames)
+
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._func = func
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> Iterable[str]:
+        values = self._values
+        if self._func:
+            try:
+                values = {(): self._func()}
+
+            except Exception:
+                logger.error('failed to collect %s', self.name, exc_info=True)
+                return
+
+        yield from super().collect()
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._get_key(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help_: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help_, labelnames)
+
+        self._buckets = tuple(buckets) + (float('inf'),)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._get_key(labels)
+        counts, total = self._values.setdefault(key, ([0] * len(self._buckets), [0.0]))
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+
+        total[0] += value
+
+    def collect(self) -> Iterable[str]:
+        yield from super().collect()
+
+        names = self.labelnames + ('le',)
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total[0])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+def _get_rss() -> float:
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _get_peak_rss() -> float:
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+PROCESS_RSS = Gauge('process_resident_memory_bytes', 'Resident memory size in bytes.', func=_get_rss)
+PROCESS_PEAK_RSS = Gauge(
+    'process_peak_resident_memory_bytes',
+    'Peak resident memory size in bytes.',
+    func=_get_peak_rss
+)
+PROCESS_CPU = Counter(
+    'process_cpu_seconds_total',
+    'Total user and system CPU time spent in seconds.',
+    func=time.process_time
+)
+LOOP_LAG = Histogram(
+    'tcfrontend_event_loop_lag_seconds',
+    'Delay of event loop callbacks beyond their scheduled time.',
+    buckets=LOOP_LAG_BUCKETS
+)
+SLOW_CALLBACKS = Counter('tcfrontend_event_loop_slow_callbacks_total', 'Times the event loop was found blocked.')
+TRANSITION_RSS = Gauge(
+    'tcfrontend_state_transition_resident_memory_bytes',
+    'Resident memory size when last entering each state.',
+    ('state',)
+)
+
+
+async def _loop_lag_task_func() -> None:
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(time.monotonic() - start - LOOP_LAG_INTERVAL, 0)
+        LOOP_LAG.observe(lag)
+
+
+def _watchdog_thread_func(loop: asyncio.AbstractEventLoop, loop_thread_id: int) -> None:
+    beat = threading.Event()
+    while True:
+        beat.clear()
+        start = time.monotonic()
+
+        try:
+            loop.call_soon_threadsafe(beat.set)
+
+        except RuntimeError:  # Loop closed
+            return
+
+        if not beat.wait(SLOW_CALLBACK_DURATION):
+            # Whatever the loop is running right now is what blocks it
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            logger.warning('event loop blocked for over %.3f seconds, in:\n%s', SLOW_CALLBACK_DURATION, stack.rstrip())
+
+            beat.wait()
+            SLOW_CALLBACKS.inc()
+            logger.warning('event loop blocked for %.3f seconds', time.monotonic() - start)
+
+        time.sleep(SLOW_CALLBACK_DURATION * WATCHDOG_INTERVAL)
+
+
+def get_memory_usage() -> Dict[str, Any]:
+    usage = {'time': time.time(), 'rss': _get_rss(), 'peak_rss': _get_peak_rss()}
+
+    # Python allocations are only known while tracemalloc is running (e.g. started with PYTHONTRACEMALLOC=1)
+    if tracemalloc.is_tracing():
+        usage['traced'], usage['traced_peak'] = tracemalloc.get_traced_memory()
+
+    return usage
+
+
+def sample_memory(from_state: str, to_state: str) -> None:
+    sample = get_memory_usage()
+    sample['from_state'] = from_state
+    sample['to_state'] = to_state
+
+    # Peak of Python allocations is per state, where the Python version allows resetting it
+    if 'traced' in sample and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+    _memory_samples.append(sample)
+    TRANSITION_RSS.set(sample['rss'], state=to_state)
+
+
+def get_memory_samples() -> List[Dict[str, Any]]:
+    return list(_memory_samples)
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+
+    lines.append('')
+
+    return '\n'.join(lines)
+
+
+def init() -> None:
+    global _loop_lag_task
+    global _watchdog_thread
+
+    _loop_lag_task = asyncio.create_task(_loop_lag_task_func())
+
+    if SLOW_CALLBACK_DURATION is not None:
+        args = (asyncio.get_event_loop(), threading.get_ident())
+        _watchdog_thread = threading.Thread(target=_watchdog_thread_func, args=args, name='watchdog', daemon=True)
+        _watchdog_thread.start()
@@ -0,0 +1,135 @@
+
+import asyncio
+import functools
+import re
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pexpect
+
+
+Marker = Tuple[str, bytes, bool]
+CompiledMarker = Tuple[str, 're.Pattern', bool]
+
+
+def _compile_keyword(keyword: bytes) -> bytes:
+    # Matches the keyword, or any start of it that the data ends with, e.g. P(?:r(?:e(?:s(?:s|\Z)|\Z)|\Z)|\Z)
+    pattern = re.escape(keyword[-1:])
+    for i in range(len(keyword) - 2, -1, -1):
+        pattern = re.escape(keyword[i:i + 1]) + b'(?:' + pattern + rb'|\Z)'
+
+    return pattern
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_markers(markers: Tuple[Marker, ...]) -> Tuple[Dict[bytes, CompiledMarker], 're.Pattern']:
+    compiled = {}
+    for name, pattern, prompt in markers:
+        keyword = re.match(rb'[^\\\[\](){}.*+?^$|]*', pattern).group()
+        if not keyword or any(k.startswith(keyword) or keyword.startswith(k) for k in compiled):
+            raise ValueError(f'Pattern of marker {name} does not start with a unique keyword')
+
+        compiled[keyword] = (name, re.compile(pattern), prompt)
+
+    # All keywords are looked for at once; full patterns are only tried where a keyword has been found. Keywords cut
+    # short by the end of the data are found as well, so that only they need to be kept for the next chunk.
+    keywords = re.compile(b'|'.join(_compile_keyword(k) for k in compiled))
+
+    return compiled, keywords
+
+
+class OutputParser:
+    # Markers are (name, pattern, prompt) tuples, and each pattern must start with a literal keyword. Prompts are
+    # matched before their line is complete, since tuya-convert doesn't output a newline until it gets an answer; other
+    # markers are matched once their line is complete.
+    def __init__(self, markers: List[Marker], callback: Optional[Callable[[str, Dict[str, str]], None]] = None) -> None:
+        self._callback = callback
+        self._markers, self._keywords = _compile_markers(tuple(markers))
+
+        self._tail = b''
+        self._results: Dict[str, Dict[str, str]] = {}
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._error: Optional[Exception] = None
+
+    def feed(self, data: bytes) -> None:
+        buffer = self._tail + data
+        lines_end = buffer.rfind(b'\n') + 1
+
+        # Keywords are looked for one at a time, as they're few and far between; search() skips ahead to the next one
+        # without the cost of iterating over matches
+        search = self._keywords.search
+        start = 0
+        pending_pos = None
+        hit = search(buffer)
+        while hit is not None:
+            pos = hit.start()
+            marker = self._markers.get(hit.group())
+            if marker is None:
+                # Start of a keyword, at the end of the data
+                if pending_pos is None:
+                    pending_pos = pos
+
+                break
+
+            name, pattern, prompt = marker
+            if pos < lines_end:
+                match = pattern.match(buffer, pos, lines_end)
+
+            else:
+                match = pattern.match(buffer, pos) if prompt else None
+                if match is None and pending_pos is None:
+                    pending_pos = pos
+
+            if match:
+                start = match.end()
+                pending_pos = None
+                self._handle(name, match)
+                hit = search(buffer, start)
+
+            else:
+                hit = search(buffer, hit.end())
+
+        # Only what may still turn into a match is kept around, from the first keyword still waiting for the rest of its
+        # line, its prompt or the rest of itself; everything else has been scanned for good
+        self._tail = buffer[pending_pos:] if pending_pos is not None else b''
+
+    def discard(self) -> None:
+        # Markers that have been matched but not waited for are forgotten
+        self._results.clear()
+
+    def close(self, error: Exception) -> None:
+        self._error = error
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def wait(self, name: str, timeout: float) -> Dict[str, str]:
+        result = self._results.pop(name, None)
+        if result is not None:
+            return result
+
+        if self._error:
+            raise self._error
+
+        future = self._waiters[name] = asyncio.get_event_loop().create_future()
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+
+        except asyncio.TimeoutError:
+            raise pexpect.TIMEOUT(f'Timeout waiting for {name}') from None
+
+        finally:
+            self._waiters.pop(name, None)
+
+    def _handle(self, name: str, match: 're.Match') -> None:
+        groups = {k: v.decode(errors='replace') for k, v in match.groupdict().items() if v is not None}
+        if self._callback:
+            self._callback(name, groups)
+
+        future = self._waiters.get(name)
+        if future and not future.done():
+            future.set_result(groups)
+
+        else:
+            self._results[name] = groups
@@ -0,0 +1,49 @@
+
+import threading
+
+from tcfrontend.jsonindex import JSONIndex
+
+
+class PhaseDurations:
+    # Durations of successful tuya-convert phases, as recorded on this station, from which phase timeouts are derived: a
+    # high percentile times a margin, within bounds given per phase. Until enough durations have been recorded for a
+    # phase, its default timeout is used. Methods may be called from I/O threads.
+    MAX_SAMPLES = 200
+    MIN_SAMPLES = 20
+    PERCENTILE = 0.99
+    MARGIN = 2
+
+    def __init__(self, path: str) -> None:
+        self._durations = JSONIndex(path)
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        with self._lock:
+            self._durations.load()
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+
+            self._durations.save()
+            self._dirty = False
+
+    def add(self, phase: str, duration: float) -> None:
+        with self._lock:
+            durations = self._durations.load().setdefault(phase, [])
+            durations.append(round(duration, 3))
+            del durations[:-self.MAX_SAMPLES]
+            self._dirty = True
+
+    def get_timeout(self, phase: str, default: float, floor: float, ceiling: float) -> float:
+        with self._lock:
+            durations = sorted(self._durations.load().get(phase, ()))
+
+        if len(durations) < self.MIN_SAMPLES:
+            return default
+
+        value = durations[min(int(len(durations) * self.PERCENTILE), len(durations) - 1)] * self.MARGIN
+
+        return round(min(max(value, floor), ceiling), 3)
@@ -1,10 +1,13 @@
 
 import asyncio
 import base64
+import json
 import logging
+import time
 
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
+from tcfrontend import metrics
 from tcfrontend import tccontrol
 
 
@@ -41,7 +44,9 @@ TRANSITION_REQUEST_FUNCS = {
 }
 
 STATE_GET_PARAM_FUNCS = {
-    STATE_CONVERTED: lambda: {k: v for k, v in tccontrol.get_conversion_details().items() if k != 'original_firmware'}
+    STATE_CONVERTED: lambda: {
+        k: v for k, v in tccontrol.get_conversion_details().items() if k != 'original_firmware_path'
+    }
 }
 
 STATE_PREPROCESS_PARAM_FUNCS = {
@@ -51,13 +56,22 @@ STATE_PREPROCESS_PARAM_FUNCS = {
     }
 }
 
-UPDATE_INTERVAL = 1
+# Transitions are normally triggered by tccontrol change notifications; periodic checks are just a safety net
+UPDATE_INTERVAL = 30
 UPDATE_INTERVAL_ERROR = 5
 
+TRANSITIONS = metrics.Counter('tcfrontend_state_transitions_total', 'State transitions.', ('from_state', 'to_state'))
+STATE_DURATION = metrics.Histogram('tcfrontend_state_duration_seconds', 'Time spent in each state.', ('state',))
+
 
 logger = logging.getLogger(__name__)
 
 _state: str = STATE_READY
+_state_params: Dict[str, Any] = {}
+_state_version: int = 0
+_state_snapshot: Optional[str] = None
+_state_changed_event: Optional[asyncio.Event] = None
+_state_time: float = time.monotonic()
 _update_task: asyncio.Task
 
 
@@ -73,8 +87,13 @@ class InvalidTransitionRequest(TransitionException):
         super().__init__(f'Invalid transition request: ${old_state} -> ${new_state}')
 
 
+class InvalidTransitionParams(TransitionException):
+    pass
+
+
 def check_transition():
     global _state
+    global _state_time
 
     if tccontrol.is_flashing():
         new_state = STATE_FLASHING
@@ -100,11 +119,47 @@ def check_transition():
     else:
         new_state = STATE_READY
 
-    if _state == new_state:
+    func = STATE_GET_PARAM_FUNCS.get(new_state)
+    new_params = func() if func else {}
+
+    # Batch progress and automatic retries are reported along with any state
+    batch = tccontrol.get_batch()
+    if batch is not None:
+        new_params['batch'] = batch
+
+    retry_attempts = tccontrol.get_retry_attempts()
+    if retry_attempts:
+        new_params['retry_attempts'] = retry_attempts
+
+    if _state == new_state and _state_params == new_params:
         return
 
-    logger.debug('transition %s -> %s', _state, new_state)
+    if _state != new_state:
+        logger.debug('transition %s -> %s', _state, new_state)
+
+        now = time.monotonic()
+        STATE_DURATION.observe(now - _state_time, state=_state)
+        TRANSITIONS.inc(from_state=_state, to_state=new_state)
+        metrics.sample_memory(_state, new_state)
+        _state_time = now
+
     _state = new_state
+    _set_state_params(new_params)
+
+
+def _set_state_params(params: Dict[str, Any]) -> None:
+    global _state_params
+    global _state_version
+    global _state_snapshot
+    global _state_changed_event
+
+    _state_params = params
+    _state_version += 1
+    _state_snapshot = None  # Serialized lazily, on first request
+
+    if _state_changed_event:
+        _state_changed_event.set()
+        _state_changed_event = None
 
 
 async def update_loop():
@@ -132,16 +187,41 @@ def get_state() -> str:
 
 
 def get_state_params() -> Dict[str, Any]:
-    func = STATE_GET_PARAM_FUNCS.get(_state)
-    if not func:
-        return {}
+    return _state_params
+
+
+def get_state_version() -> int:
+    return _state_version
+
+
+def get_state_snapshot() -> Tuple[int, str]:
+    global _state_snapshot
+
+    if _state_snapshot is None:
+        _state_snapshot = json.dumps({
+            'state': _state,
+            'params': _state_params,
+            'version': _state_version
+        })
 
-    return func()
+    return _state_version, _state_snapshot
+
+
+async def wait_state_change(version: int) -> None:
+    global _state_changed_event
+
+    while _state_version == version:
+        if _state_changed_event is None:
+            _state_changed_event = asyncio.Event()
+
+        await _state_changed_event.wait()
 
 
 async def handle_transition_request(old_state: str, new_state: str, **params: Any) -> None:
     func = TRANSITION_REQUEST_FUNCS[(old_state, new_state)]
-    func(**params)
+    result = func(**params)
+    if asyncio.iscoroutine(result):
+        await result
 
 
 async def request_state(new_state: str, **params: Any) -> None:
@@ -155,9 +235,14 @@ async def request_state(new_state: str, **params: Any) -> None:
     if (_state, new_state) not in TRANSITION_REQUEST_FUNCS:
         raise InvalidTransitionRequest(_state, new_state)
 
+    # Preprocessing may decode large payloads, so it's done off the event loop
     func = STATE_PREPROCESS_PARAM_FUNCS.get(new_state)
     if func:
-        params = func(params)
+        try:
+            params = await tccontrol.run_io(func, params)
+
+        except Exception as e:
+            raise InvalidTransitionParams(f'Invalid params: {e}') from e
 
     try:
         await handle_transition_request(_state, new_state, **params)
@@ -173,4 +258,5 @@ async def request_state(new_state: str, **params: Any) -> None:
 def init() -> None:
     global _update_task
 
+    tccontrol.add_change_callback(check_transition)
     _update_task = asyncio.create_task(update_loop())
@@ -95,6 +95,17 @@ function deepEquals(obj1, obj2) {
     }
 }
 
+/**
+ * @param {String} text
+ * @returns {String}
+ */
+function escapeHTML(text) {
+    let div = document.createElement('div')
+    div.innerText = text
+
+    return div.innerHTML
+}
+
 
 /* AJAX */
 
@@ -151,9 +162,17 @@ function requestJSON({method, path, query = null, body = null}) {
  * @param {Object} [query]
  * @param {ArrayBuffer} [body]
  * @param {String} [contentType]
+ * @param {?Function} [onProgress]
  * @returns {Promise}
  */
-function requestBinary({method, path, query = null, body = null, contentType = 'application/octet-stream'}) {
+function requestBinary({
+    method,
+    path,
+    query = null,
+    body = null,
+    contentType = 'application/octet-stream',
+    onProgress = null
+}) {
     return new Promise(function (resolve, reject) {
         let request = new XMLHttpRequest()
 
@@ -164,6 +183,12 @@ function requestBinary({method, path, query = null, body = null, contentType = '
         request.open(method, path, true)
         request.responseType = 'arraybuffer'
 
+        if (onProgress) {
+            request.onprogress = function (e) {
+                onProgress(e.loaded, e.lengthComputable ? e.total : null)
+            }
+        }
+
         if (body != null) {
             request.setRequestHeader('Content-Type', contentType)
             request.send(body)
@@ -187,6 +212,28 @@ function requestBinary({method, path, query = null, body = null, contentType = '
     })
 }
 
+/**
+ * @param {Object} error
+ * @returns {?String} the message the server rejected the request with, as HTML
+ */
+function getErrorMessage(error) {
+    let body = error.body
+    if (body instanceof ArrayBuffer) {
+        try {
+            body = JSON.parse(new TextDecoder().decode(body))
+        }
+        catch (e) {
+            body = null
+        }
+    }
+
+    if (!body || !body.error) {
+        return null
+    }
+
+    return escapeHTML(body.error)
+}
+
 
 /* API requests */
 
@@ -209,11 +256,23 @@ function apiPatchStatus(stateName, params = {}) {
     })
 }
 
+/**
+ * @param {Uint8Array} firmware
+ * @returns {Promise}
+ */
+function apiUploadFirmware(firmware) {
+    return requestBinary({method: 'PUT', path: '/firmware/custom.bin', body: firmware}).catch(function (e) {
+        setState('server-communication-error')
+        throw e
+    })
+}
+
 /**
  * @param {String} url
+ * @param {?Function} [onProgress]
  */
-function apiDownloadFirmware(url) {
-    return requestBinary({method: 'GET', path: '/firmware/proxy', query: {url}})
+function apiDownloadFirmware(url, onProgress = null) {
+    return requestBinary({method: 'GET', path: '/firmware/proxy', query: {url}, onProgress})
 }
 
 
@@ -290,20 +349,11 @@ class State {
 
     /**
      * @param {ArrayBuffer} firmware
-     * @param {?Object} flashParams
-     * @returns {String}
+     * @returns {Uint8Array}
      */
-    prepareFirmware(firmware, flashParams) {
-        let uint8Array = new Uint8Array(currentFirmwareContent).slice(0, 512 * 1024)
-        if (flashParams) {
-            uint8Array[2] = FIRMWARE_FLASH_SPI_MODES[flashParams['flash_mode']]
-            uint8Array[3] = FIRMWARE_FLASH_SIZES[flashParams['flash_size']] << 4
-            uint8Array[3] += FIRMWARE_FLASH_FREQS[flashParams['flash_freq']]
-        }
-
-        let string = uint8Array.reduce((data, byte) => data + String.fromCharCode(byte), '')
-
-        return btoa(string)
+    prepareFirmware(firmware) {
+        /* Flash params are patched into the firmware header by the server */
+        return new Uint8Array(firmware).slice(0, 512 * 1024)
     }
 
     onEnter() {
@@ -337,8 +387,30 @@ class State {
             flash_size: flashSizeSelect.value
         }
 
-        apiPatchStatus('flashing', {firmware: this.prepareFirmware(currentFirmwareContent, flashParams)})
-        setState('loading', {message: 'Starting flashing...'})
+        /* Firmware the server turns down is reported with the server's reason */
+        function handleError(e) {
+            let message = getErrorMessage(e)
+            if (message) {
+                setState('flashing-error', {message: message})
+            }
+        }
+
+        if (currentFirmwareURL) {
+            /* Let the server download the firmware by itself */
+            apiPatchStatus('flashing', {
+                firmware_url: currentFirmwareURL,
+                flash_params: flashParams,
+                patch_header: true
+            }).catch(handleError)
+            setState('loading', {message: 'Starting flashing...'})
+            return
+        }
+
+        setState('loading', {message: 'Uploading firmware...'})
+        apiUploadFirmware(this.prepareFirmware(currentFirmwareContent)).then(function () {
+            setState('loading', {message: 'Starting flashing...'})
+            return apiPatchStatus('flashing', {flash_params: flashParams, patch_header: true})
+        }).catch(handleError)
     }
 
 }
@@ -634,35 +706,66 @@ function showStatus(state, details) {
 function initStatus() {
     setState('loading', {message: 'Loading...'})
 
-    setInterval(function () {
+    function pollStatus() {
         apiGetStatus().then(function (status) {
             setState(status.state, status.params)
+        }).catch(function () {
+            setState('server-communication-error')
         })
-    }, 1000)
+    }
+
+    if (!window.EventSource) {
+        /* Fall back to polling on browsers that don't support server-sent events */
+        setInterval(pollStatus, 1000)
+
+        return
+    }
+
+    let eventSource = null
+    let pollInterval = null
+
+    function connect() {
+        /* The browser reconnects automatically, resuming from the last received state version */
+        eventSource = new EventSource('/status/events')
+
+        eventSource.onopen = function () {
+            clearInterval(pollInterval)
+            pollInterval = null
+        }
+
+        eventSource.onmessage = function (e) {
+            let status = JSON.parse(e.data)
+            setState(status.state, status.params)
+        }
+
+        /* Status is polled while the stream is down; the browser gives up reconnecting on HTTP errors, in which case
+         * a new stream is opened once the server answers again */
+        eventSource.onerror = function () {
+            setState('server-communication-error')
+
+            if (pollInterval == null) {
+                pollInterval = setInterval(function () {
+                    if (eventSource.readyState === EventSource.CLOSED) {
+                        apiGetStatus().then(connect).catch(function () {})
+                    }
+                    else {
+                        pollStatus()
+                    }
+                }, 1000)
+            }
+        }
+    }
+
+    connect()
 }
 
 
 /* Firmware */
 
 let currentFirmwareContent = null
+let currentFirmwareURL = null
 
 const FIRMWARE_MAGIC = 0xE9
-const FIRMWARE_FLASH_SPI_MODES = {
-    'QIO': 0x00,
-    'QOUT': 0x01,
-    'DIO': 0x02,
-    'DOUT': 0x03
-}
-const FIRMWARE_FLASH_SIZES = {
-    1: 0x2,
-    2: 0x3,
-    4: 0x4
-}
-const FIRMWARE_FLASH_FREQS = {
-    40: 0x0,
-    26: 0x2,
-    80: 0xF
-}
 
 
 function initFirmware() {
@@ -700,18 +803,28 @@ function initFirmware() {
 
         showFirmwareDetails({message: 'Checking firmware...', progress: true})
 
+        function handleProgress(loaded, total) {
+            let message = 'Downloading firmware...'
+            if (total) {
+                message = `Downloading firmware... ${Math.floor(loaded * 100 / total)}%`
+            }
+
+            showFirmwareDetails({message: message, size: loaded, progress: true})
+        }
+
         /* Try to download file at indicated URL */
-        apiDownloadFirmware(firmwareURLTextInput.value).then(function (response) {
+        apiDownloadFirmware(firmwareURLTextInput.value, handleProgress).then(function (response) {
 
             let result = validateFirmware(response.body)
             showFirmwareDetails(result)
 
             if (result.valid) {
-                showPointOfNoReturn(response.body)
+                showPointOfNoReturn(response.body, firmwareURLTextInput.value)
             }
 
-        }).catch(function () {
-            showFirmwareDetails({message: 'Could not download file at given URL', valid: false})
+        }).catch(function (e) {
+            let message = getErrorMessage(e) || 'Could not download file at given URL'
+            showFirmwareDetails({message: message, valid: false})
         })
     })
 
@@ -810,11 +923,13 @@ function hideFirmwareDetails() {
 
 /**
  * @param {ArrayBuffer} firmwareContent
+ * @param {?String} [firmwareURL]
  */
-function showPointOfNoReturn(firmwareContent) {
+function showPointOfNoReturn(firmwareContent, firmwareURL = null) {
     document.getElementById('pointOfNoReturnDiv').classList.add('visible')
 
     currentFirmwareContent = firmwareContent
+    currentFirmwareURL = firmwareURL
     
     let flashFrequencySelect = document.getElementById('flashFrequencySelect')
     let flashModeSelect = document.getElementById('flashModeSelect')
@@ -830,6 +945,7 @@ function hidePointOfNoReturn() {
     document.getElementById('pointOfNoReturnCheck').checked = false
 
     currentFirmwareContent = null
+    currentFirmwareURL = null
 }
 
 /**
@@ -0,0 +1,159 @@
+
+import gzip
+import io
+import logging
+import mimetypes
+import os
+
+from typing import Callable, Dict, Optional, Set
+
+from tornado.web import StaticFileHandler
+
+try:
+    import brotli
+
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+COMPRESSIBLE_EXTENSIONS = {'.css', '.html', '.js', '.svg'}
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# Versioned URLs, as returned by static_url(), change whenever the content does
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Supported encodings, in order of preference, along with the suffix of their precompressed files
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+logger = logging.getLogger(__name__)
+
+
+def _compress_gzip(data: bytes) -> bytes:
+    # No file name and a fixed timestamp, so that the output only depends on the content
+    # (gzip.compress() only takes mtime as of Python 3.8)
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as f:
+        f.write(data)
+
+    return buf.getvalue()
+
+
+def _compress_brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def _get_compress_funcs() -> Dict[str, Callable[[bytes], bytes]]:
+    funcs = {'.gz': _compress_gzip}
+    if brotli:
+        funcs['.br'] = _compress_brotli
+
+    return funcs
+
+
+def build(static_dir: str = STATIC_DIR) -> None:
+    # Precompressed files are (re)created next to their originals whenever they are missing or out of date
+    funcs = _get_compress_funcs()
+
+    for name in sorted(os.listdir(static_dir)):
+        path = os.path.join(static_dir, name)
+        if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS or not os.path.isfile(path):
+            continue
+
+        mtime = os.path.getmtime(path)
+        data = None
+        for _, suffix in ENCODINGS:
+            compressed_path = path + suffix
+            try:
+                if os.path.getmtime(compressed_path) >= mtime:
+                    continue
+
+            except FileNotFoundError:
+                pass
+
+            # Out of date variants that can't be recreated here must not be served
+            func = funcs.get(suffix)
+            if func is None:
+                try:
+                    os.remove(compressed_path)
+
+                except FileNotFoundError:
+                    pass
+
+                continue
+
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+            compressed = func(data)
+            tmp_path = f'{compressed_path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(compressed)
+
+            os.replace(tmp_path, compressed_path)
+
+            logger.debug('compressed %s to %s (%s -> %s bytes)', name, suffix, len(data), len(compressed))
+
+
+def _parse_accept_encoding(value: str) -> Set[str]:
+    encodings = set()
+    for item in value.split(','):
+        name, *params = item.strip().split(';')
+        quality = 1.0
+        for param in params:
+            key, _, param_value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(param_value)
+
+                except ValueError:
+                    pass
+
+        if name and quality > 0:
+            encodings.add(name.strip().lower())
+
+    return encodings
+
+
+class PrecompressedStaticFileHandler(StaticFileHandler):
+    # Serves the precompressed variant of a file, if there is one the client accepts; everything else (ETag, Range,
+    # If-None-Match) is handled by StaticFileHandler on the variant actually served
+
+    _original_path: Optional[str] = None
+    _encoding: Optional[str] = None
+
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        if absolute_path is None:
+            return None
+
+        self._original_path = absolute_path
+        if os.path.splitext(absolute_path)[1] not in COMPRESSIBLE_EXTENSIONS:
+            return absolute_path
+
+        accepted = _parse_accept_encoding(self.request.headers.get('Accept-Encoding', ''))
+        for encoding, suffix in ENCODINGS:
+            compressed_path = absolute_path + suffix
+            if encoding in accepted and os.path.isfile(compressed_path):
+                # StaticFileHandler may have already cached the stat result of the original file
+                self._stat_result = os.stat(compressed_path)
+                self._encoding = encoding
+                return compressed_path
+
+        return absolute_path
+
+    def get_content_type(self) -> str:
+        mime_type, _ = mimetypes.guess_type(self._original_path)
+        return mime_type or 'application/octet-stream'
+
+    def set_extra_headers(self, path: str) -> None:
+        if os.path.splitext(self._original_path)[1] in COMPRESSIBLE_EXTENSIONS:
+            self.set_header('Vary', 'Accept-Encoding')
+
+        if self._encoding:
+            self.set_header('Content-Encoding', self._encoding)
+
+        if self.get_query_argument('v', None):
+            self.set_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
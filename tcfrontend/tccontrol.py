@@ -1,18 +1,79 @@
 
 import asyncio
+import collections
+import ctypes
+import functools
 import io
 import logging
+import mmap
 import os
 import pexpect
-import re
+import shutil
 import signal
-
-from typing import Any, Dict, Optional
-
+import tempfile
+import time
+
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from tcfrontend import firmwareimage
+from tcfrontend.backupstore import BackupStore
+from tcfrontend.iothreads import run_io
+from tcfrontend.firmwarecache import FirmwareCache
+from tcfrontend.firmwaredownload import FirmwareDownload
+from tcfrontend.firmwarelibrary import FirmwareLibrary
+from tcfrontend import metrics
+from tcfrontend import transcript
+from tcfrontend.outputparser import OutputParser
+from tcfrontend.phasedurations import PhaseDurations
+
+
+# Keep tuya-convert running between devices, so that its AP, DNS and MQTT services don't have to be set up again
+WARM_RESTART = True
+
+# Prepare a new tuya-convert process in the background, up to its "Press ENTER" prompt, whenever the previous one has
+# been stopped
+STANDBY_PROCESS = True
+
+# Failed conversions and flashes are retried automatically, up to a number of times per device that depends on the
+# class of the error, i.e. on the phase that failed (see TCProcess.ERROR_CLASSES); 0 leaves retrying to the user. The
+# delay before each attempt doubles, up to a maximum. As pairing timeouts adapt to how long devices usually take, stuck
+# devices are given up on early.
+RETRY_ATTEMPTS = {
+    'setup': 2,
+    'pairing': 2,
+    'device_info': 2,
+    'flashing': 1
+}
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+# Number of devices handled in batch mode that are remembered
+BATCH_HISTORY = 100
+
+PR_SET_CHILD_SUBREAPER = 36
+STOP_POLL_INTERVAL = 0.02
+
+PHASE_DURATION = metrics.Histogram(
+    'tcfrontend_phase_duration_seconds',
+    'Time spent waiting for tuya-convert phases, by outcome.',
+    ('phase', 'outcome')
+)
+CONVERSIONS = metrics.Counter('tcfrontend_conversions_total', 'Conversions by outcome.', ('outcome',))
+FLASHES = metrics.Counter('tcfrontend_flashes_total', 'Flashing attempts by outcome.', ('outcome',))
+RETRIES = metrics.Counter('tcfrontend_retries_total', 'Automatic retries, by error class.', ('error_class',))
+BATCH_DEVICES = metrics.Counter(
+    'tcfrontend_batch_devices_total',
+    'Devices handled in batch mode, by outcome.',
+    ('outcome',)
+)
 
 logger = logging.getLogger(__name__)
 
 _process: Optional['TCProcess'] = None
+_stop_task: Optional[asyncio.Task] = None
+
+_standby_process: Optional['TCProcess'] = None
+_standby_task: Optional[asyncio.Task] = None
 
 _conversion_task: Optional[asyncio.Task] = None
 _conversion_details: Optional[Dict[str, Any]] = None
@@ -23,36 +84,380 @@ _flashing_task: Optional[asyncio.Task] = None
 _flashing_error: Optional[Exception] = None
 _flashing_done: bool = False
 
+_retry_attempts: Dict[str, int] = {}
+
+_batch: Optional[Dict[str, Any]] = None
+_batch_devices: collections.deque = collections.deque(maxlen=BATCH_HISTORY)
+
+_backup_store: Optional[BackupStore] = None
+_firmware_cache: Optional[FirmwareCache] = None
+_firmware_library: Optional[FirmwareLibrary] = None
+_phase_durations: Optional[PhaseDurations] = None
+_change_callbacks: List[Callable[[], None]] = []
+_child_subreaper: Optional[bool] = None
+
+
+class FirmwareUnavailable(Exception):
+    # Firmware requested by URL or by library ID couldn't be obtained
+    pass
+
 
 class LogIO(io.TextIOBase):
-    def __init__(self, prefix):
+    # Control characters other than line endings are dropped; carriage returns are handled by keeping only the last
+    # version of a redrawn line
+    DELETE_CHARS = bytes(c for c in range(0x20) if c not in b'\r\n')
+
+    def __init__(self, prefix: str, transcript: bool = False) -> None:
         self.prefix = prefix
+        self.transcript = transcript
+        self._pending = b''
+
+        # Transcript output is held back until the process is taken into use, so that a standby process doesn't write
+        # into the session of the process before it
+        self._held: Optional[bytearray] = bytearray() if transcript else None
 
     def write(self, b: bytes) -> int:
-        s = b.decode()
-        for line in s.split('\n'):
-            line = re.sub(r'[\x00-\x1f]', '', line)
-            if line:
-                logger.debug('%s %s', self.prefix, line)
+        data = b.translate(None, self.DELETE_CHARS)
+        if self._held is not None:
+            self._held += data
+            del self._held[:-transcript.SIZE]
+
+        elif self.transcript:
+            transcript.write(data)
+
+        lines = (self._pending + data).split(b'\n')
+
+        # Keep the incomplete last line for later, without any of its versions that have already been redrawn
+        pending = lines.pop()
+        self._pending = pending[pending.rfind(b'\r', 0, -1) + 1:]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for line in lines:
+                line = line.rstrip(b'\r')
+                line = line[line.rfind(b'\r') + 1:]
+                if line:
+                    logger.debug('%s %s', self.prefix, line.decode(errors='replace'))
 
         return len(b)
 
+    def release_transcript(self, new_session: bool) -> None:
+        if new_session:
+            transcript.start_session()
+
+        if self._held:
+            transcript.write(bytes(self._held))
+
+        self._held = None
+
+
+def _ensure_child_subreaper() -> None:
+    global _child_subreaper
+
+    if _child_subreaper is not None:
+        return
+
+    # Daemons started by tuya-convert (hostapd, dnsmasq, mosquitto, screen sessions) are reparented to us instead of
+    # init, so that they can be found among our descendants when stopping
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+            raise OSError(ctypes.get_errno(), 'prctl(PR_SET_CHILD_SUBREAPER) failed')
+
+        _child_subreaper = True
+
+    except Exception:
+        logger.warning('could not become child subreaper', exc_info=True)
+        _child_subreaper = False
+
+
+def _read_proc_stat(pid: int) -> Optional[List[bytes]]:
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+
+    except OSError:
+        return None
+
+    # Process name may contain spaces and parentheses; fields that follow it start with state and ppid
+    return stat[stat.rindex(b')') + 2:].split()
+
+
+def _has_environ(pid: int, entry: bytes) -> bool:
+    try:
+        with open(f'/proc/{pid}/environ', 'rb') as f:
+            return entry in f.read().split(b'\0')
+
+    except OSError:
+        return False
+
+
+def _get_descendants(pid: int, session: Optional[int] = None, marker: Optional[bytes] = None) -> List[int]:
+    # Given a session, its processes are included too, and so are processes reparented to us that carry the marker in
+    # their environment, i.e. daemons that have started sessions of their own; other processes reparented to us belong
+    # to other tuya-convert processes
+    children = {}
+    roots = [pid]
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        child = int(name)
+        fields = _read_proc_stat(child)
+        if not fields:
+            continue
+
+        children.setdefault(int(fields[1]), []).append(child)
+
+        if session is None or child == pid:
+            continue
+
+        if int(fields[3]) == session or (int(fields[1]) == os.getpid() and _has_environ(child, marker)):
+            roots.append(child)
+
+    descendants = set(roots[1:])
+    pending = roots
+    while pending:
+        for child in children.get(pending.pop(), []):
+            if child not in descendants:
+                descendants.add(child)
+                pending.append(child)
+
+    return list(descendants)
+
+
+def _is_alive(pid: int) -> bool:
+    fields = _read_proc_stat(pid)
+    if fields is None:
+        return False
+
+    if fields[0] != b'Z':
+        return True
+
+    # Reap our own zombie children; others will be reaped by their parents
+    if int(fields[1]) == os.getpid():
+        try:
+            os.waitpid(pid, os.WNOHANG)
+
+        except ChildProcessError:
+            pass
+
+    return False
+
+
+def _signal(pids: Iterable[int], sig: int) -> None:
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+
+        except ProcessLookupError:
+            pass
+
+
+async def _wait_exit(pids: Iterable[int], timeout: float, is_alive: Callable[[int], bool] = _is_alive) -> Set[int]:
+    pids = set(pids)
+    deadline = time.monotonic() + timeout
+    while True:
+        pids = {pid for pid in pids if is_alive(pid)}
+        if not pids or time.monotonic() >= deadline:
+            return pids
+
+        await asyncio.sleep(STOP_POLL_INTERVAL)
+
+
+def create_upload_file() -> BinaryIO:
+    # Uploads are kept on the same file system as the files they end up as, so that they can be moved there
+    return tempfile.NamedTemporaryFile(dir=TCProcess.TUYA_CONVERT_DIR, prefix='_upload-', suffix='.tmp', delete=False)
+
+
+def remove_upload_file(f: BinaryIO) -> None:
+    f.close()
+
+    try:
+        os.remove(f.name)
+
+    except FileNotFoundError:
+        pass  # Moved already
+
+
+def _copy_file(path: str, f: BinaryIO) -> None:
+    with open(path, 'rb') as src:
+        shutil.copyfileobj(src, f)
+
+
+def _timed_phase(func: Callable) -> Callable:
+    phase = func.__name__.lstrip('_')[len('run_until_'):]
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.monotonic()
+        outcome = 'failure'
+
+        try:
+            result = await func(*args, **kwargs)
+            outcome = 'success'
+            return result
+
+        except asyncio.CancelledError:
+            outcome = 'cancel'
+            raise
+
+        finally:
+            PHASE_DURATION.observe(time.monotonic() - start, phase=phase, outcome=outcome)
+
+    return wrapper
+
 
 class TCProcess(pexpect.spawn):
     TUYA_CONVERT_DIR = '/root/tuya-convert'
     BACKUPS_DIR = os.path.join(TUYA_CONVERT_DIR, 'backups')
+    BACKUP_STORE_DIR = os.path.join(BACKUPS_DIR, 'store')
+    FIRMWARE_CACHE_DIR = os.path.join(TUYA_CONVERT_DIR, 'firmware-cache')
+    FIRMWARE_LIBRARY_DIR = os.path.join(TUYA_CONVERT_DIR, 'firmware-library')
+    PHASE_DURATIONS_FILE = os.path.join(TUYA_CONVERT_DIR, 'phase-durations.json')
     SKIP_BACKUP_FLAG_FILE = os.path.join(TUYA_CONVERT_DIR, '_skip_backup')
     CUSTOM_FIRMWARE_FILE = os.path.join(TUYA_CONVERT_DIR, 'files', '_custom.bin')
+    # Kept out of the files directory, which tuya-convert lists in its firmware picker
+    BATCH_FIRMWARE_FILE = os.path.join(TUYA_CONVERT_DIR, '_batch.bin')
+    RETRY_FIRMWARE_FILE = os.path.join(TUYA_CONVERT_DIR, '_retry.bin')
     CMD = os.path.join(TUYA_CONVERT_DIR, 'start_flash.sh')
+    MARKER_ENV = 'TCFRONTEND_PROCESS'
     DEFAULT_EXPECT_TIMEOUT = 2
     CONVERT_TIMEOUT = 180
     FLASH_TIMEOUT = 60
+    MIN_FIRMWARE_SIZE = 1024
+    MAX_FIRMWARE_SIZE = 512 * 1024
+    NEXT_DEVICE_TIMEOUT = 10
+    STOP_TIMEOUT = 1
     MAGIC = b'\xE9'
 
+    # Processes started so far, for telling their daemons apart
+    _count = 0
+
+    # Default, floor and ceiling of the timeout of each phase, in seconds; see PhaseDurations. Getting ready for pairing
+    # the first time includes setting up tuya-convert's services, later times (warm restarts) take hardly any time.
+    PHASE_TIMEOUTS = {
+        'pairing_ready_cold': (10, 10, 60),
+        'pairing_ready_warm': (10, 5, 60),
+        'original_firmware': (CONVERT_TIMEOUT, 30, 300),
+        'chip_id_pairing': (CONVERT_TIMEOUT, 30, 300),
+        'chip_id': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'mac': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'flash_mode': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'flash_chip_id': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'ready_to_flash': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'firmware_picker': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'point_of_no_return': (DEFAULT_EXPECT_TIMEOUT, DEFAULT_EXPECT_TIMEOUT, 30),
+        'flashed_successfully': (FLASH_TIMEOUT, 30, 180),
+        'next_device': (NEXT_DEVICE_TIMEOUT, 5, 60)
+    }
+
+    # Class of errors occurring in each phase, for the purpose of retrying
+    ERROR_CLASSES = {
+        'pairing_ready_cold': 'setup',
+        'pairing_ready_warm': 'setup',
+        'next_device': 'setup',
+        'original_firmware': 'pairing',
+        'chip_id_pairing': 'pairing',
+        'chip_id': 'device_info',
+        'mac': 'device_info',
+        'flash_mode': 'device_info',
+        'flash_chip_id': 'device_info',
+        'ready_to_flash': 'device_info',
+        'firmware_picker': 'device_info',
+        'point_of_no_return': 'flashing',
+        'flashed_successfully': 'flashing'
+    }
+
+    # Markers are matched all at once, in whatever order tuya-convert outputs them; see OutputParser
+    OUTPUT_MARKERS = [
+        ('pairing_ready', rb'Press [^\s]+ to continue', True),
+        ('original_firmware', rb"curl: Saved to filename '(?P<original_firmware_file>[a-zA-Z0-9-]+\.bin)'", False),
+        ('chip_id', rb'ChipID: (?P<chip_id>[^\r\n]*)', False),
+        ('mac', rb'MAC: (?P<mac>[a-fA-F0-9:]+)', False),
+        ('flash_mode', rb'FlashMode: (?P<flash_size>\d+)M (?P<flash_mode>[A-Z]+) @ (?P<flash_freq>\d+)MHz', False),
+        ('flash_chip_id', rb'FlashChipId: (?P<flash_chip_id>\d+)', False),
+        ('ready_to_flash', rb'Ready to flash third party firmware!', False),
+        ('firmware_picker', rb'Please select 0-\d:', True),
+        ('point_of_no_return', rb'This is the point of no return \[y/N\]', True),
+        ('flashed_successfully', rb'successfully in \d+ms, rebooting\.\.\.', False),
+        # Either "flash another device" or, when the device didn't show up, "try flashing another device"
+        ('next_device', rb'another device\? \[y/N\]', True)
+    ]
+
     def __init__(self, download_backup: Optional[bool]) -> None:
+        self._firmware_file = None
+        self._next_device = None
+        self._set_up = False
+        self._parser = OutputParser(self.OUTPUT_MARKERS, self._on_output_marker)
+
+        logger.debug('starting tuya-convert process')
+
+        self._prepare(download_backup)
+        _ensure_child_subreaper()
+
+        # Environment is inherited by daemons that leave the session, so that they can be told apart when stopping
+        TCProcess._count += 1
+        process_id = f'{os.getpid()}-{TCProcess._count}'
+        self._marker = f'{self.MARKER_ENV}={process_id}'.encode()
+
+        # The pty makes tuya-convert the leader of its own session and process group
+        super().__init__(self.CMD, cwd=self.TUYA_CONVERT_DIR, env=dict(os.environ, **{self.MARKER_ENV: process_id}))
+
+        self.logfile_read = LogIO('<<<', transcript=True)
+        self.logfile_send = LogIO('>>>')
+
+        # Output is read by us rather than by pexpect's expect(), so that each chunk is parsed exactly once
+        self._reading = True
+        asyncio.get_event_loop().add_reader(self.child_fd, self._on_readable)
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self.child_fd, self.maxread)
+
+        except OSError:  # Linux reports EIO once the child side of the pty is closed
+            data = b''
+
+        if not data:
+            self._stop_reading()
+            return
+
+        self.logfile_read.write(data)
+        self._parser.feed(data)
+
+    def _stop_reading(self) -> None:
+        if not self._reading:
+            return
+
+        self._reading = False
+        asyncio.get_event_loop().remove_reader(self.child_fd)
+        self._parser.close(pexpect.EOF('End of file from tuya-convert process'))
+
+    def _on_output_marker(self, name: str, groups: Dict[str, str]) -> None:
+        # Conversion details are filled in as soon as they show up
+        if name == 'chip_id':
+            self._chip_id = groups['chip_id']
+            logger.debug('got chip id: %s', self._chip_id)
+
+        elif name == 'mac':
+            self._mac = groups['mac']
+            logger.debug('got mac: %s', self._mac)
+
+        elif name == 'flash_mode':
+            self._flash_mode = groups['flash_mode']
+            self._flash_freq = int(groups['flash_freq'])
+            self._flash_size = int(groups['flash_size'])
+            logger.debug('got flash mode: %s, freq: %s, size: %s', self._flash_mode, self._flash_freq, self._flash_size)
+
+        elif name == 'flash_chip_id':
+            self._flash_chip_id = groups['flash_chip_id']
+            logger.debug('got flash chip id: %s', self._flash_chip_id)
+
+    def _prepare(self, download_backup: Optional[bool]) -> None:
         self._download_backup = download_backup
-    
-        self._original_firmware = None
+
+        self._original_firmware_path = None
+        self._original_firmware_size = None
+        self._original_firmware_sha256 = None
         self._chip_id = None
         self._mac = None
         self._flash_mode = None
@@ -62,78 +467,186 @@ class TCProcess(pexpect.spawn):
 
         self._conversion_ready = False
         self._flashing_ready = False
+        self._firmware_size = None
 
-        logger.debug('starting tuya-convert process')
+        self._started_time = time.monotonic()
+        self._setup_duration = None
+        self._pairing_ready = False
 
+        self._timeouts = {}
+        self._failed_phase = None
+
+    @classmethod
+    def _prepare_files(cls, download_backup: Optional[bool]) -> None:
         # Create a dummy custom firmware file placeholder; tuya-convert will pick it up as first option
-        with open(self.CUSTOM_FIRMWARE_FILE, 'wb') as f:
-            f.write(self.MAGIC * 300 * 1024)
-        
+        with open(cls.CUSTOM_FIRMWARE_FILE, 'wb') as f:
+            f.write(cls.MAGIC * 300 * 1024)
+
         if download_backup is not None:
             if download_backup:
                 try:
-                    os.remove(self.SKIP_BACKUP_FLAG_FILE)
-                
+                    os.remove(cls.SKIP_BACKUP_FLAG_FILE)
+
                 except FileNotFoundError:
                     pass
-            
+
             else:
-                with open(self.SKIP_BACKUP_FLAG_FILE, 'w'):
+                with open(cls.SKIP_BACKUP_FLAG_FILE, 'w'):
                     pass
 
-        super().__init__(self.CMD, cwd=self.TUYA_CONVERT_DIR)
+    @classmethod
+    async def create(cls, download_backup: Optional[bool]) -> 'TCProcess':
+        # Files tuya-convert looks at are written off the event loop, before the process is started
+        await run_io(cls._prepare_files, download_backup)
 
-        self.logfile_read = LogIO('<<<')
-        self.logfile_send = LogIO('>>>')
+        return cls(download_backup)
 
     def is_running(self) -> bool:
         return self.isalive()
 
+    def start_transcript(self, new_session: bool = True) -> None:
+        # Called once the process is taken into use, by a new conversion or, without a new session, to go on with a
+        # failed one; output so far goes into the transcript along with what follows
+        self.logfile_read.release_transcript(new_session)
+
+    def get_download_backup(self) -> Optional[bool]:
+        return self._download_backup
+
+    def is_reusable(self) -> bool:
+        # Process can be reused once it's waiting at the firmware picker or has flashed a device
+        return self.isalive() and (self._conversion_ready or self._flashing_ready)
+
+    async def reset(self, download_backup: Optional[bool]) -> None:
+        logger.debug('reusing tuya-convert process for next device')
+
+        # Remember where tuya-convert currently waits, so that we know how to get it to the next device
+        self._next_device = 'flashed' if self._flashing_ready else 'picker'
+        self._prepare(download_backup)
+        await run_io(self._prepare_files, download_backup)
+
+    async def _wait(self, name: str, phase: Optional[str] = None) -> Dict[str, str]:
+        # Waits for an output marker, within the timeout of its phase; phase durations are recorded as they succeed
+        phase = phase or name
+        timeout = get_phase_durations().get_timeout(phase, *self.PHASE_TIMEOUTS[phase])
+        self._timeouts[phase] = timeout
+
+        start = time.monotonic()
+
+        try:
+            result = await self._parser.wait(name, timeout)
+
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            self._failed_phase = phase
+            raise
+
+        get_phase_durations().add(phase, time.monotonic() - start)
+
+        return result
+
+    def get_error_class(self) -> Optional[str]:
+        return self.ERROR_CLASSES.get(self._failed_phase)
+
+    async def restart_pairing(self) -> bool:
+        # Once tuya-convert has given up on a device, it offers to go on with another one, which gets it back to pairing
+        # without setting everything up again; returns False if it's not there
+        if not self.isalive():
+            return False
+
+        try:
+            await self._parser.wait('next_device', 0)
+
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            return False
+
+        logger.debug('restarting pairing')
+
+        self._parser.discard()
+        self._prepare(self._download_backup)
+        self.send('y')
+
+        return True
+
+    def is_next_device_pending(self) -> bool:
+        return self._next_device is not None
+
+    @_timed_phase
+    async def run_until_next_device(self) -> None:
+        if self._next_device == 'picker':
+            # Quit the firmware picker without flashing anything
+            self.send('q')
+
+        self._next_device = None
+        await self._wait('next_device')
+        self.send('y')
+
     async def stop(self) -> None:
         logger.debug('stopping tuya-convert process')
 
-        if self.isalive():
-            self.kill(signal.SIGTERM)
+        # Once reaped by pexpect, the main process ID may belong to an unrelated process, and so may its group ID
+        alive = not self.terminated and self.isalive()
 
-        # Allow process to gracefully stop
-        await asyncio.sleep(1)
+        # Orphaned daemons are reparented to us rather than to init, so they can still be found by our session and
+        # marker, even once the main process is gone; a standby process started meanwhile is left alone
+        pids = set()
+        if _child_subreaper:
+            pids.update(await run_io(_get_descendants, self.pid, self.pid, self._marker))
 
-        if self.isalive():
-            self.kill(signal.SIGKILL)
+        elif alive:
+            pids.update(await run_io(_get_descendants, self.pid))
 
-        os.system('ps aux | grep hostapd | grep -v grep | tr -s ' ' | cut -d ' ' -f 2 | xargs -r kill -9')
-        os.system('ps aux | grep smarthack | grep -v grep | tr -s ' ' | cut -d ' ' -f 2 | xargs -r kill -9')
-        os.system('ps aux | grep mosquitto | grep -v grep | tr -s ' ' | cut -d ' ' -f 2 | xargs -r kill -9')
-        os.system('ps aux | grep dnsmasq | grep -v grep | tr -s ' ' | cut -d ' ' -f 2 | xargs -r kill -9')
+        pids.discard(self.pid)
 
-    async def run_conversion(self):
-        await self._run_until_press_enter()
-        logger.debug('smart config pairing procedure started')
+        if alive:
+            pids.add(self.pid)
 
-        if self._download_backup:
-            self._original_firmware = await self._run_until_original_firmware()
-            logger.debug('got original firmware')
+            try:
+                os.killpg(self.pid, signal.SIGTERM)
 
-        self._chip_id = await self._run_until_chip_id()
-        logger.debug('got chip id: %s', self._chip_id)
+            except ProcessLookupError:
+                pass
 
-        self._mac = await self._run_until_mac()
-        logger.debug('got mac: %s', self._mac)
+        _signal(pids, signal.SIGTERM)
 
-        flash_details = await self._run_until_flash_mode()
-        logger.debug('got flash details')
+        # Main process is reaped by pexpect itself
+        def is_alive(pid: int) -> bool:
+            return self.isalive() if pid == self.pid else _is_alive(pid)
 
-        self._flash_chip_id = await self._run_until_flash_chip_id()
-        logger.debug('got flash chip id: %s', self._flash_chip_id)
+        # Allow processes to gracefully stop
+        pids = await _wait_exit(pids, self.STOP_TIMEOUT, is_alive)
+        if pids:
+            logger.debug('killing %s remaining tuya-convert processes', len(pids))
+            _signal(pids, signal.SIGKILL)
+            pids = await _wait_exit(pids, self.STOP_TIMEOUT, is_alive)
 
-        self._flash_mode = flash_details['flash_mode']
-        logger.debug('got flash mode: %s', self._flash_mode)
+        if pids:
+            logger.warning('tuya-convert processes %s did not exit', ', '.join(str(p) for p in sorted(pids)))
 
-        self._flash_freq = flash_details['flash_freq']
-        logger.debug('got flash freq: %s', self._flash_freq)
+        # Processes have already been waited for, so there's no need for ptyprocess to sleep before checking on them
+        self._stop_reading()
+        self.ptyproc.delayafterclose = 0
+        self.close(force=True)
 
-        self._flash_size = flash_details['flash_size']
-        logger.debug('got flash size: %s', self._flash_size)
+    async def run_conversion(self):
+        await self._run_until_press_enter()
+        logger.debug('smart config pairing procedure started')
+
+        backup_path = None
+        if self._download_backup:
+            backup_path = await self._run_until_original_firmware()
+            logger.debug('got original firmware: %s', backup_path)
+
+        # Device info lines may come in any order; each step returns right away if its line has already been parsed
+        await self._run_until_chip_id()
+        await self._run_until_mac()
+        await self._run_until_flash_mode()
+        await self._run_until_flash_chip_id()
+
+        if backup_path:
+            store = get_backup_store()
+            entry = await run_io(store.add, backup_path, self._mac, self._chip_id)
+            self._original_firmware_path = store.get_path(entry)
+            self._original_firmware_size = entry['size']
+            self._original_firmware_sha256 = entry['sha256']
 
         await self._run_until_ready_to_flash()
 
@@ -147,66 +660,187 @@ class TCProcess(pexpect.spawn):
             return None
 
         return {
-            'original_firmware': self._original_firmware,
-            'has_original_firmware': self._original_firmware is not None,
+            'original_firmware_path': self._original_firmware_path,
+            'original_firmware_size': self._original_firmware_size,
+            'original_firmware_sha256': self._original_firmware_sha256,
+            'has_original_firmware': self._original_firmware_path is not None,
             'chip_id': self._chip_id,
             'mac': self._mac,
             'flash_mode': self._flash_mode,
             'flash_freq': self._flash_freq,
             'flash_size': self._flash_size,
-            'flash_chip_id': self._flash_chip_id
+            'flash_chip_id': self._flash_chip_id,
+            'setup_duration': self._setup_duration,
+            'timeouts': dict(self._timeouts)
         }
 
+    @_timed_phase
+    async def run_until_pairing_ready(self) -> None:
+        await self._wait('pairing_ready', 'pairing_ready_warm' if self._set_up else 'pairing_ready_cold')
+
+        self._set_up = True
+        self._pairing_ready = True
+        self._setup_duration = round(time.monotonic() - self._started_time, 3)
+        logger.info('tuya-convert ready for pairing after %s seconds', self._setup_duration)
+
+    def is_pairing_ready(self) -> bool:
+        return self._pairing_ready
+
     async def _run_until_press_enter(self) -> None:
-        await self.expect(r'Press [^\s]+ to continue', timeout=10, async_=True)
+        # Not timed as a phase of its own: waiting for the prompt is already timed as pairing_ready, and a standby
+        # process has already reached it
+        if not self._pairing_ready:
+            await self.run_until_pairing_ready()
+
         self.sendline()
 
-    async def _run_until_original_firmware(self) -> bytes:
-        await self.expect(r"curl: Saved to filename '([a-zA-Z0-9-]+.bin)'", timeout=self.CONVERT_TIMEOUT, async_=True)
-        filename = self.match.group(1).decode()
+    @_timed_phase
+    async def _run_until_original_firmware(self) -> str:
+        result = await self._wait('original_firmware')
+
+        return await run_io(self._find_original_firmware, result['original_firmware_file'])
 
-        # Look through backups/*/*.bin for original firmware file; use most recent backup
+    def _find_original_firmware(self, filename: str) -> str:
+        # Backups that have been added to the store are moved out of the backups dir, so usually only the one created
+        # by the current tuya-convert run is left to look through
         dirs = [os.path.join(self.BACKUPS_DIR, d) for d in os.listdir(self.BACKUPS_DIR)]
+        dirs = [d for d in dirs if d != self.BACKUP_STORE_DIR and os.path.isfile(os.path.join(d, filename))]
         dirs.sort(key=lambda d: os.stat(d).st_mtime, reverse=True)
 
-        for d in dirs:
-            path = os.path.join(d, filename)
-            if os.path.isfile(path):
-                with open(path, 'rb') as f:
-                    return f.read()
+        if not dirs:
+            raise Exception('Could not find original firmware file')
 
-        raise Exception('Could not find original firmware file')
+        return os.path.join(dirs[0], filename)
 
-    async def _run_until_chip_id(self) -> str:
-        timeout = self.DEFAULT_EXPECT_TIMEOUT if self._download_backup else self.CONVERT_TIMEOUT
-        await self.expect(r"ChipID: (.*?)\n", timeout=timeout, async_=True)
-        return self.match.group(1).decode()
+    @_timed_phase
+    async def _run_until_chip_id(self) -> None:
+        # Without a backup to download first, the chip id is the first thing to show up once the device has paired
+        await self._wait('chip_id', 'chip_id' if self._download_backup else 'chip_id_pairing')
 
-    async def _run_until_mac(self) -> str:
-        await self.expect(r"MAC: ([a-fA-F0-9:]+)", timeout=self.DEFAULT_EXPECT_TIMEOUT, async_=True)
-        return self.match.group(1).decode()
+    @_timed_phase
+    async def _run_until_mac(self) -> None:
+        await self._wait('mac')
 
-    async def _run_until_flash_mode(self) -> Dict[str, Any]:
-        await self.expect(r"FlashMode: (\d+)M ([A-Z]+) @ (\d+)MHz", timeout=self.DEFAULT_EXPECT_TIMEOUT, async_=True)
-        return {
-            'flash_size': int(self.match.group(1)),
-            'flash_mode': self.match.group(2).decode(),
-            'flash_freq': int(self.match.group(3))
-        }
+    @_timed_phase
+    async def _run_until_flash_mode(self) -> None:
+        await self._wait('flash_mode')
 
-    async def _run_until_flash_chip_id(self) -> str:
-        await self.expect(r"FlashChipId: (\d+)", timeout=self.DEFAULT_EXPECT_TIMEOUT, async_=True)
-        return self.match.group(1).decode()
+    @_timed_phase
+    async def _run_until_flash_chip_id(self) -> None:
+        await self._wait('flash_chip_id')
 
+    @_timed_phase
     async def _run_until_ready_to_flash(self) -> None:
-        await self.expect('Ready to flash third party firmware!', timeout=self.DEFAULT_EXPECT_TIMEOUT, async_=True)
-        await self.expect(r'Please select 0-\d:\s*', timeout=self.DEFAULT_EXPECT_TIMEOUT, async_=True)
+        await self._wait('ready_to_flash')
+        await self._wait('firmware_picker')
+
+    def open_firmware(self) -> BinaryIO:
+        if self._firmware_file is not None:
+            raise Exception('Firmware file is busy')
+
+        logger.debug('opening firmware file %s', self.CUSTOM_FIRMWARE_FILE)
+
+        # Until the file is closed, its content can't be trusted
+        self._firmware_size = None
+        self._firmware_file = open(self.CUSTOM_FIRMWARE_FILE, 'wb')
+
+        return self._firmware_file
+
+    def close_firmware(self, f: BinaryIO) -> None:
+        size = f.tell()
+        f.close()
+        self._firmware_file = None
+
+        logger.debug('wrote %s bytes to firmware file %s', size, self.CUSTOM_FIRMWARE_FILE)
+        self._firmware_size = size
+
+    def discard_firmware(self, f: BinaryIO) -> None:
+        f.close()
+        self._firmware_file = None
+
+        logger.debug('discarded firmware file %s', self.CUSTOM_FIRMWARE_FILE)
+
+    async def write_firmware(self, firmware: bytes) -> None:
+        f = self.open_firmware()
+
+        try:
+            await run_io(f.write, firmware)
+
+        except Exception:
+            self.discard_firmware(f)
+            raise
+
+        self.close_firmware(f)
+
+    async def copy_firmware(self, path: str) -> None:
+        f = self.open_firmware()
+
+        try:
+            await run_io(_copy_file, path, f)
+
+        except Exception:
+            self.discard_firmware(f)
+            raise
+
+        self.close_firmware(f)
+
+    async def download_firmware(self, url: str) -> None:
+        logger.debug('downloading firmware file at %s', url)
+
+        # Clients usually have the file revalidated through the proxy just before, so it rarely needs downloading again
+        download = FirmwareDownload(url, get_firmware_cache())
+        f = self.open_firmware()
+
+        try:
+            await download.start()
+
+            while True:
+                chunk = await download.read()
+                if not chunk:
+                    break
+
+                # Like firmware supplied by clients, larger files are truncated
+                await run_io(f.write, chunk[:self.MAX_FIRMWARE_SIZE - f.tell()])
+
+        except firmwareimage.FirmwareError:
+            self.discard_firmware(f)
+            raise
+
+        except Exception as e:
+            self.discard_firmware(f)
+            raise FirmwareUnavailable(f'Could not download firmware: {e}') from e
+
+        else:
+            self.close_firmware(f)
+
+        finally:
+            download.close()
+
+    def has_firmware(self) -> bool:
+        return bool(self._firmware_size)
+
+    def check_firmware(self, flash_params: Dict[str, Any], patch_header: bool = False) -> Dict[str, Any]:
+        if self._firmware_size < self.MIN_FIRMWARE_SIZE:
+            raise firmwareimage.FirmwareError(f'Firmware must have at least {self.MIN_FIRMWARE_SIZE} bytes')
+
+        # Map the file so that the header can be parsed and patched without reading the whole image
+        with open(self.CUSTOM_FIRMWARE_FILE, 'r+b') as f, mmap.mmap(f.fileno(), 0) as m:
+            data = memoryview(m)
 
-    def write_firmware(self, firmware: bytes) -> None:
-        logger.debug('writing %s bytes to firmware file %s', len(firmware), self.CUSTOM_FIRMWARE_FILE)
+            try:
+                header = firmwareimage.parse_header(data)
+                if patch_header:
+                    logger.debug('patching firmware header with flash params %s', flash_params)
+                    firmwareimage.patch_flash_params(data, flash_params)
+                    header = firmwareimage.parse_header(data, partial=True)
 
-        with open(self.CUSTOM_FIRMWARE_FILE, 'wb') as f:
-            f.write(firmware)
+                else:
+                    firmwareimage.check_flash_params(header, flash_params)
+
+            finally:
+                data.release()
+
+        return header
 
     async def run_flashing(self):
         await self._run_until_point_of_no_return()
@@ -217,20 +851,205 @@ class TCProcess(pexpect.spawn):
     def is_flashing_ready(self) -> bool:
         return self._flashing_ready
 
+    @_timed_phase
     async def _run_until_point_of_no_return(self) -> None:
         self.send('1')
-        await self.expect(
-            r'This is the point of no return \[y/N\]\s+',
-            timeout=self.DEFAULT_EXPECT_TIMEOUT,
-            async_=True
-        )
+        await self._wait('point_of_no_return')
         self.send('y')
 
+    @_timed_phase
     async def _run_until_flashed_successfully(self) -> None:
-        await self.expect(r'successfully in \d+ms, rebooting\.\.\.', timeout=self.FLASH_TIMEOUT, async_=True)
+        await self._wait('flashed_successfully')
+
+
+def get_backup_store() -> BackupStore:
+    global _backup_store
+
+    if _backup_store is None:
+        _backup_store = BackupStore(TCProcess.BACKUP_STORE_DIR)
+
+    return _backup_store
+
+
+def get_firmware_cache() -> FirmwareCache:
+    global _firmware_cache
+
+    if _firmware_cache is None:
+        _firmware_cache = FirmwareCache(TCProcess.FIRMWARE_CACHE_DIR)
+
+    return _firmware_cache
+
+
+def get_firmware_library() -> FirmwareLibrary:
+    global _firmware_library
+
+    if _firmware_library is None:
+        _firmware_library = FirmwareLibrary(TCProcess.FIRMWARE_LIBRARY_DIR)
+
+    return _firmware_library
+
+
+async def _wait_retry(error_class: Optional[str]) -> bool:
+    # Waits before the next attempt, if any are left for the class of the error
+    attempts = _retry_attempts.get(error_class, 0)
+    if error_class is None or attempts >= RETRY_ATTEMPTS.get(error_class, 0):
+        return False
+
+    attempts = _retry_attempts[error_class] = attempts + 1
+    delay = min(RETRY_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    logger.warning(
+        'retrying after %s error (%s/%s) in %s seconds', error_class, attempts, RETRY_ATTEMPTS[error_class], delay
+    )
+
+    RETRIES.inc(error_class=error_class)
+    _notify_change()
+
+    await asyncio.sleep(delay)
+
+    return True
 
 
-async def _conversion_task_func():
+async def _restart_process() -> None:
+    global _process
+
+    if await _process.restart_pairing():
+        return
+
+    logger.info('starting a new tuya-convert process for retrying')
+
+    download_backup = _process.get_download_backup()
+    await _process.stop()
+    _process = await TCProcess.create(download_backup)
+    _process.start_transcript(new_session=False)
+
+
+async def _reflash() -> None:
+    # Flashing is retried from the start, with the device converted again; the firmware is kept aside meanwhile, as a
+    # new process starts with a placeholder in its place
+    await run_io(shutil.copyfile, TCProcess.CUSTOM_FIRMWARE_FILE, TCProcess.RETRY_FIRMWARE_FILE)
+    await _restart_process()
+    await _process.run_conversion()
+    await _process.copy_firmware(TCProcess.RETRY_FIRMWARE_FILE)
+
+    details = _process.get_conversion_details()
+    flash_params = {k: details[k] for k in ('flash_mode', 'flash_size', 'flash_freq')}
+    await run_io(_process.check_firmware, flash_params)
+
+
+def get_retry_attempts() -> Dict[str, int]:
+    return dict(_retry_attempts)
+
+
+def get_phase_durations() -> PhaseDurations:
+    global _phase_durations
+
+    if _phase_durations is None:
+        _phase_durations = PhaseDurations(TCProcess.PHASE_DURATIONS_FILE)
+
+    return _phase_durations
+
+
+async def _save_phase_durations() -> None:
+    try:
+        await run_io(get_phase_durations().save)
+
+    except Exception:
+        logger.error('failed to save phase durations', exc_info=True)
+
+
+def add_change_callback(callback: Callable[[], None]) -> None:
+    _change_callbacks.append(callback)
+
+
+def remove_change_callback(callback: Callable[[], None]) -> None:
+    _change_callbacks.remove(callback)
+
+
+def _notify_change() -> None:
+    for callback in _change_callbacks:
+        try:
+            callback()
+
+        except Exception:
+            logger.error('change callback failed', exc_info=True)
+
+
+async def _stop_process(process: TCProcess, standby: bool) -> None:
+    await process.stop()
+
+    if standby:
+        await _start_standby(process.get_download_backup())
+
+
+def _stop_process_later(process: TCProcess, standby: bool) -> None:
+    global _stop_task
+
+    _stop_task = asyncio.create_task(_stop_process(process, standby))
+
+
+async def _standby_task_func() -> None:
+    assert _standby_process is not None
+
+    try:
+        await _standby_process.run_until_pairing_ready()
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception:
+        # Process will be replaced when taken
+        logger.error('standby process failed', exc_info=True)
+
+    else:
+        logger.info('standby process ready')
+
+
+async def _start_standby(download_backup: Optional[bool]) -> None:
+    global _standby_process
+    global _standby_task
+
+    if not STANDBY_PROCESS or _process or _standby_process:
+        return
+
+    logger.info('starting standby process')
+
+    process = await TCProcess.create(download_backup)
+    if _process or _standby_process:
+        # A conversion has started in the meantime
+        await process.stop()
+        return
+
+    _standby_process = process
+    _standby_task = asyncio.create_task(_standby_task_func())
+
+
+async def _take_standby(download_backup: Optional[bool]) -> Tuple[Optional[TCProcess], Optional[asyncio.Task]]:
+    global _standby_process
+    global _standby_task
+
+    process, task = _standby_process, _standby_task
+    _standby_process = _standby_task = None
+
+    if process is None:
+        return None, None
+
+    failed = task.done() and not process.is_pairing_ready()
+    mismatched = download_backup is not None and download_backup != process.get_download_backup()
+    if failed or mismatched:
+        logger.info('discarding standby process')
+
+        task.cancel()
+        await asyncio.wait([task])
+        await process.stop()
+
+        return None, None
+
+    logger.info('using standby process')
+
+    return process, task
+
+
+async def _conversion_task_func(standby_task: Optional[asyncio.Task]):
     global _process
     global _conversion_task
     global _conversion_error
@@ -243,28 +1062,70 @@ async def _conversion_task_func():
     _conversion_details = None
     _flashing_done = False
     _flashing_error = None
+    _retry_attempts.clear()
 
     try:
-        await _process.run_conversion()
+        if standby_task:
+            await standby_task
+
+        if _process.is_next_device_pending():
+            try:
+                await _process.run_until_next_device()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                logger.warning('could not reuse tuya-convert process, starting a new one', exc_info=True)
+
+                download_backup = _process.get_download_backup()
+                await _process.stop()
+                _process = await TCProcess.create(download_backup)
+                _process.start_transcript(new_session=False)
+
+        while True:
+            try:
+                await _process.run_conversion()
+                break
+
+            except (pexpect.TIMEOUT, pexpect.EOF):
+                if not await _wait_retry(_process.get_error_class()):
+                    raise
+
+            await _restart_process()
 
     except asyncio.CancelledError:
         logger.info('conversion task cancelled')
+        CONVERSIONS.inc(outcome='cancel')
         if _process:
             await _process.stop()
             _process = None
 
     except Exception as e:
         logger.error('conversion task failed', exc_info=True)
+        CONVERSIONS.inc(outcome='failure')
         _conversion_error = e
+        if _batch:
+            _record_batch_device('conversion-error', None)
+
         if _process:
-            await _process.stop()
+            process = _process
             _process = None
+            await _stop_process(process, standby=True)
 
     else:
         logger.info('conversion task ended', exc_info=True)
+        CONVERSIONS.inc(outcome='success')
         _conversion_details = _process.get_conversion_details()
 
+    await _save_phase_durations()
+
     _conversion_task = None
+    _notify_change()
+
+    # In batch mode, converted devices are flashed right away
+    if _batch and _conversion_details is not None:
+        await _start_batch_flash()
 
 
 async def _restart_conversion(download_backup: Optional[bool]):
@@ -276,26 +1137,41 @@ async def _restart_conversion(download_backup: Optional[bool]):
         _conversion_task.cancel()
         await _conversion_task
 
-    if _process:
+    if _process and not (WARM_RESTART and _process.is_reusable()):
         await _process.stop()
         _process = None
 
-    start_conversion(download_backup)
+    await start_conversion(download_backup)
 
 
-def start_conversion(download_backup: Optional[bool] = None) -> None:
+async def start_conversion(download_backup: Optional[bool] = None) -> None:
     global _process
     global _conversion_task
     global _conversion_cancelled
 
     logger.info('starting conversion')
 
-    assert _process is None
     assert _conversion_task is None
 
-    _process = TCProcess(download_backup)
+    # Previous process must be completely gone before a new one sets up its services
+    if _stop_task:
+        await asyncio.wait([_stop_task])
+
+    standby_task = None
+    if _process is not None and WARM_RESTART and _process.is_reusable():
+        await _process.reset(download_backup)
+
+    else:
+        assert _process is None
+        _process, standby_task = await _take_standby(download_backup)
+        if _process is None:
+            _process = await TCProcess.create(download_backup)
+
+    _process.start_transcript()
+
     _conversion_cancelled = False
-    _conversion_task = asyncio.create_task(_conversion_task_func())
+    _conversion_task = asyncio.create_task(_conversion_task_func(standby_task))
+    _notify_change()
 
 
 def restart_conversion(download_backup: Optional[bool] = None) -> None:
@@ -315,13 +1191,14 @@ def cancel_conversion() -> None:
     assert _conversion_task is not None
 
     _conversion_task.cancel()
-    asyncio.create_task(_process.stop())
+    _stop_process_later(_process, standby=True)
 
     _conversion_task = None
     _conversion_error = None
     _conversion_details = None
     _conversion_cancelled = True
     _process = None
+    _notify_change()
 
 
 def clear_conversion() -> None:
@@ -333,15 +1210,16 @@ def clear_conversion() -> None:
 
     logger.info('clearing conversion')
 
-    asyncio.create_task(_process.stop())
-
     assert _process is not None
     assert _conversion_task is None
 
+    _stop_process_later(_process, standby=True)
+
     _conversion_error = None
     _conversion_details = None
     _conversion_cancelled = True
     _process = None
+    _notify_change()
 
 
 def is_converting() -> bool:
@@ -371,29 +1249,85 @@ async def _flashing_task_func():
     assert _process.is_conversion_ready()
     _flashing_error = None
     _flashing_done = False
+    details = _conversion_details
 
     try:
-        await _process.run_flashing()
+        while True:
+            try:
+                await _process.run_flashing()
+                break
+
+            except (pexpect.TIMEOUT, pexpect.EOF):
+                if not await _wait_retry(_process.get_error_class()):
+                    raise
+
+            await _reflash()
 
     except Exception as e:
         logger.error('flashing task failed', exc_info=True)
+        FLASHES.inc(outcome='failure')
         _flashing_error = e
+        if _batch:
+            _record_batch_device('flashing-error', details)
+
         if _process:
-            await _process.stop()
+            process = _process
             _process = None
+            await _stop_process(process, standby=True)
 
     else:
         logger.info('flashing task ended', exc_info=True)
+        FLASHES.inc(outcome='success')
         _conversion_details = None
         _flashing_done = True
-        if _process:
-            await _process.stop()
+        if _batch:
+            _record_batch_device('flashed', details)
+
+        if _process and not WARM_RESTART:
+            process = _process
             _process = None
+            await _stop_process(process, standby=True)
+
+    await _save_phase_durations()
 
     _flashing_task = None
+    _notify_change()
+
+    # In batch mode, the next device is converted as soon as one has been flashed
+    if _batch and _flashing_done:
+        await _start_batch_conversion()
+
+
+def open_firmware() -> BinaryIO:
+    assert _process is not None
+    assert _flashing_task is None
+
+    return _process.open_firmware()
+
+
+def close_firmware(f: BinaryIO) -> None:
+    if _process is None:
+        f.close()
+        return
+
+    _process.close_firmware(f)
 
 
-def start_flash(firmware: bytes) -> None:
+def discard_firmware(f: BinaryIO) -> None:
+    if _process is None:
+        f.close()
+        return
+
+    _process.discard_firmware(f)
+
+
+async def start_flash(
+    firmware: Optional[bytes] = None,
+    firmware_url: Optional[str] = None,
+    firmware_id: Optional[str] = None,
+    flash_params: Optional[Dict[str, Any]] = None,
+    patch_header: bool = False
+) -> None:
     global _flashing_task
 
     logger.info('starting flash')
@@ -401,9 +1335,45 @@ def start_flash(firmware: bytes) -> None:
     assert _process is not None
     assert _flashing_task is None
 
-    _process.write_firmware(firmware)
+    # Firmware may be supplied inline, downloaded by URL, taken from the library or may have already been uploaded to
+    # the firmware file
+    process = _process
+    header = None
+    if firmware is not None:
+        await process.write_firmware(firmware)
+
+    elif firmware_url is not None:
+        await process.download_firmware(firmware_url)
+
+    elif firmware_id is not None:
+        # Library images can't be hard-linked, as the firmware file gets overwritten in place
+        library = get_firmware_library()
+        header = await run_io(library.get_entry, firmware_id)
+        if header is None:
+            raise FirmwareUnavailable(f'No such firmware {firmware_id}')
+
+        await process.copy_firmware(library.get_path(header))
+
+    if not process.has_firmware():
+        raise Exception('No firmware supplied')
+
+    # Unless given explicitly, firmware must match the flash params detected during conversion
+    if flash_params is None:
+        details = process.get_conversion_details()
+        flash_params = {k: details[k] for k in ('flash_mode', 'flash_size', 'flash_freq')}
+
+    # Library images have been validated when added, so only their flash params are checked
+    if header is not None and not patch_header:
+        firmwareimage.check_flash_params(header, flash_params)
+
+    else:
+        await run_io(process.check_firmware, flash_params, patch_header)
+
+    if process is not _process or _flashing_task is not None:
+        raise Exception('Conversion state changed while preparing firmware')
 
     _flashing_task = asyncio.create_task(_flashing_task_func())
+    _notify_change()
 
 
 def is_flashing() -> bool:
@@ -416,3 +1386,113 @@ def get_flashing_error() -> Optional[Exception]:
 
 def is_flashing_done() -> bool:
     return _flashing_done
+
+
+def _write_batch_firmware(path: str) -> Tuple[Dict[str, Any], str, int]:
+    size = os.path.getsize(path)
+    if not TCProcess.MIN_FIRMWARE_SIZE <= size <= TCProcess.MAX_FIRMWARE_SIZE:
+        raise firmwareimage.FirmwareError(
+            f'Firmware must have between {TCProcess.MIN_FIRMWARE_SIZE} and {TCProcess.MAX_FIRMWARE_SIZE} bytes'
+        )
+
+    header, sha256 = firmwareimage.parse_file(path)
+    os.replace(path, TCProcess.BATCH_FIRMWARE_FILE)
+
+    return header, sha256, size
+
+
+def _record_batch_device(outcome: str, details: Optional[Dict[str, Any]]) -> None:
+    logger.info('batch device %s: %s', (details or {}).get('mac'), outcome)
+
+    BATCH_DEVICES.inc(outcome=outcome)
+    _batch['tally'][outcome] = _batch['tally'].get(outcome, 0) + 1
+    _batch_devices.append({
+        'time': time.time(),
+        'mac': (details or {}).get('mac'),
+        'chip_id': (details or {}).get('chip_id'),
+        'outcome': outcome
+    })
+
+
+async def _start_batch_flash() -> None:
+    if _process is None:
+        return
+
+    logger.info('flashing batch firmware')
+
+    details = _conversion_details
+    patch_header = _batch['patch_header']
+
+    try:
+        await _process.copy_firmware(TCProcess.BATCH_FIRMWARE_FILE)
+        await start_flash(patch_header=patch_header)
+
+    except Exception:
+        # Device stays converted, so that it can still be flashed by hand
+        logger.error('batch firmware not flashed', exc_info=True)
+        if _batch:
+            _record_batch_device('rejected', details)
+            _notify_change()
+
+
+async def _start_batch_conversion() -> None:
+    logger.info('converting next batch device')
+
+    try:
+        await start_conversion(_batch['download_backup'])
+
+    except Exception:
+        logger.error('could not start batch conversion', exc_info=True)
+
+
+async def start_batch(path: str, download_backup: bool = True, patch_header: bool = False) -> None:
+    # Firmware file at path is moved to where batch mode keeps it
+    global _batch
+
+    header, sha256, size = await run_io(_write_batch_firmware, path)
+
+    logger.info('starting batch mode')
+
+    _batch = {
+        'firmware_size': size,
+        'firmware_sha256': sha256,
+        'flash_mode': header['flash_mode'],
+        'flash_size': header['flash_size'],
+        'flash_freq': header['flash_freq'],
+        'download_backup': download_backup,
+        'patch_header': patch_header,
+        'started': time.time(),
+        'tally': {}
+    }
+    _batch_devices.clear()
+    _notify_change()
+
+    # Device currently being converted or flashed is taken over once done
+    if _conversion_task or _flashing_task:
+        return
+
+    if _conversion_details is not None:
+        await _start_batch_flash()
+
+    else:
+        await _start_batch_conversion()
+
+
+def stop_batch() -> None:
+    global _batch
+
+    if _batch is None:
+        return
+
+    logger.info('stopping batch mode')
+
+    _batch = None
+    _notify_change()
+
+
+def get_batch() -> Optional[Dict[str, Any]]:
+    return dict(_batch, tally=dict(_batch['tally'])) if _batch else None
+
+
+def get_batch_devices() -> List[Dict[str, Any]]:
+    return list(_batch_devices)
@@ -0,0 +1,67 @@
+
+import asyncio
+
+from typing import Optional, Tuple
+
+
+# Output of tuya-convert is kept in a fixed-size ring buffer; offsets count all bytes ever written, so that clients can
+# follow the transcript across sessions and detect data that has already been overwritten
+SIZE = 256 * 1024
+
+_buffer = bytearray(SIZE)
+_end: int = 0
+_session_start: int = 0
+_changed_event: Optional[asyncio.Event] = None
+
+
+def start_session() -> None:
+    global _session_start
+
+    _session_start = _end
+
+
+def write(data: bytes) -> None:
+    global _end
+    global _changed_event
+
+    if len(data) > SIZE:
+        _end += len(data) - SIZE
+        data = data[-SIZE:]
+
+    pos = _end % SIZE
+    first = min(len(data), SIZE - pos)
+    _buffer[pos:pos + first] = data[:first]
+    _buffer[:len(data) - first] = data[first:]
+    _end += len(data)
+
+    if _changed_event:
+        _changed_event.set()
+        _changed_event = None
+
+
+def get_end() -> int:
+    return _end
+
+
+def read(since: int) -> Tuple[int, bytes]:
+    # Returns the offset the data actually starts at, which is later than requested if the data requested has already
+    # been overwritten or belongs to a previous session
+    start = max(since, _session_start, _end - SIZE)
+    start = min(start, _end)
+
+    pos = start % SIZE
+    size = _end - start
+    if pos + size <= SIZE:
+        return start, bytes(_buffer[pos:pos + size])
+
+    return start, bytes(_buffer[pos:]) + bytes(_buffer[:pos + size - SIZE])
+
+
+async def wait(since: int) -> None:
+    global _changed_event
+
+    while _end <= since:
+        if _changed_event is None:
+            _changed_event = asyncio.Event()
+
+        await _changed_event.wait()
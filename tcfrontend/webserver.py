@@ -1,15 +1,24 @@
 
+import asyncio
 import os
 import logging
+import pstats
 
-from typing import List
+from typing import Any, BinaryIO, Dict, List, Optional
 
 from tornado.escape import json_decode
-from tornado.httpclient import AsyncHTTPClient, HTTPClientError
-from tornado.web import Application, RequestHandler, HTTPError
-
+from tornado.httpclient import HTTPClientError
+from tornado.iostream import StreamClosedError
+from tornado.web import Application, RequestHandler, HTTPError, StaticFileHandler, stream_request_body
+
+from tcfrontend import debug
+from tcfrontend import firmwareimage
+from tcfrontend.firmwaredownload import FirmwareDownload
+from tcfrontend import metrics
 from tcfrontend import states
+from tcfrontend import staticfiles
 from tcfrontend import tccontrol
+from tcfrontend import transcript
 from tcfrontend import VERSION
 
 
@@ -29,15 +38,62 @@ class JSONRequestHandlerMixin:
         if self.request.headers.get('Content-Type') == 'application/json':
             self.json = json_decode(self.request.body)
 
+    def write_error(self, status_code: int, **kwargs: Any) -> None:
+        # Errors are reported in JSON as well, along with the message they were raised with
+        message = self._reason
+        exc_info = kwargs.get('exc_info')
+        if exc_info and isinstance(exc_info[1], HTTPError) and exc_info[1].log_message:
+            message = exc_info[1].log_message
+
+        self.finish({'error': message})
+
+
+class UploadRequestHandlerMixin:
+    # Request body of uploads is streamed to a temporary file, written out by I/O threads, rather than collected in
+    # memory; the file is removed once the request is done, unless moved elsewhere
+    UPLOAD_METHOD = 'PUT'
+
+    request = None
+    upload_size: int = 0
+    _upload_file: Optional[BinaryIO] = None
+
+    async def prepare(self) -> None:
+        if self.request.method != self.UPLOAD_METHOD:
+            return
+
+        self.request.connection.set_max_body_size(tccontrol.TCProcess.MAX_FIRMWARE_SIZE)
+        self._upload_file = await tccontrol.run_io(tccontrol.create_upload_file)
+
+    async def data_received(self, chunk: bytes) -> None:
+        if self._upload_file is not None:
+            await tccontrol.run_io(self._upload_file.write, chunk)
+            self.upload_size += len(chunk)
+
+    async def get_upload_path(self) -> str:
+        await tccontrol.run_io(self._upload_file.flush)
+
+        return self._upload_file.name
+
+    def on_finish(self) -> None:
+        self._remove_upload()
+
+    def on_connection_close(self) -> None:
+        super().on_connection_close()
+        self._remove_upload()
+
+    def _remove_upload(self) -> None:
+        if self._upload_file is not None:
+            asyncio.ensure_future(tccontrol.run_io(tccontrol.remove_upload_file, self._upload_file))
+            self._upload_file = None
+
 
 class StatusHandler(JSONRequestHandlerMixin, RequestHandler):
     def get(self) -> None:
         self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
 
-        self.finish({
-            'state': states.get_state(),
-            'params': states.get_state_params()
-        })
+        version, snapshot = states.get_state_snapshot()
+        self.finish(snapshot)
 
     async def patch(self) -> None:
         if self.json is None:
@@ -53,61 +109,524 @@ class StatusHandler(JSONRequestHandlerMixin, RequestHandler):
             await states.request_state(state, **params)
 
         except states.InvalidTransitionRequest:
-            raise HTTPError(400, f'invalid transition')
+            raise HTTPError(400, 'invalid transition')
 
+        except states.InvalidTransitionParams as e:
+            raise HTTPError(400, str(e))
 
-class FirmwareOriginalHandler(RequestHandler):
-    def get(self) -> None:
+        except states.TransitionException as e:
+            # Firmware that can't be obtained or flashed is up to the client to fix
+            if isinstance(e.__cause__, tccontrol.FirmwareUnavailable):
+                raise HTTPError(400, str(e.__cause__))
+
+            if isinstance(e.__cause__, firmwareimage.FirmwareError):
+                raise HTTPError(422, str(e.__cause__))
+
+            raise
+
+
+class StatusEventsHandler(RequestHandler):
+    KEEPALIVE_INTERVAL = 15
+
+    # Versions restart along with the server, so event IDs are qualified by a random ID of the server process
+    EPOCH = os.urandom(4).hex()
+
+    _closed: bool = False
+
+    async def get(self) -> None:
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+
+        # A reconnecting client tells us the last version it has seen; anything other than the current version of this
+        # very process means the client is out of date
+        epoch, _, version = self.request.headers.get('Last-Event-ID', '').partition('-')
+
+        try:
+            version = int(version) if epoch == self.EPOCH else None
+
+        except ValueError:
+            version = None
+
+        while not self._closed:
+            if version != states.get_state_version():
+                version, snapshot = states.get_state_snapshot()
+                self.write(f'id: {self.EPOCH}-{version}\ndata: {snapshot}\n\n')
+
+            else:
+                self.write(': keepalive\n\n')
+
+            try:
+                await self.flush()
+
+            except StreamClosedError:
+                break
+
+            try:
+                await asyncio.wait_for(states.wait_state_change(version), timeout=self.KEEPALIVE_INTERVAL)
+
+            except asyncio.TimeoutError:
+                pass
+
+    def on_connection_close(self) -> None:
+        self._closed = True
+
+
+class LogHandler(RequestHandler):
+    WAIT_INTERVAL = 15
+
+    _closed: bool = False
+
+    async def get(self) -> None:
+        try:
+            since = int(self.get_argument('since', '0'))
+
+        except ValueError:
+            raise HTTPError(400, 'invalid offset')
+
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+
+        # Transcript is streamed for as long as the client stays connected; the header tells where it starts, so that
+        # a reconnecting client can continue from the last offset it has seen
+        start, data = transcript.read(since)
+        self.set_header('X-Log-Offset', str(start))
+
+        while not self._closed:
+            if data:
+                self.write(data)
+
+            try:
+                await self.flush()
+
+            except StreamClosedError:
+                break
+
+            # Anything overwritten in the meantime is skipped
+            since = start + len(data)
+
+            try:
+                await asyncio.wait_for(transcript.wait(since), timeout=self.WAIT_INTERVAL)
+
+            except asyncio.TimeoutError:
+                pass
+
+            start, data = transcript.read(since)
+
+    def on_connection_close(self) -> None:
+        self._closed = True
+
+
+class FirmwareOriginalHandler(StaticFileHandler):
+    # Backup is streamed from disk by StaticFileHandler, which also takes care of Range and If-None-Match requests
+
+    _details: Optional[Dict[str, Any]] = None
+
+    def initialize(self) -> None:
+        super().initialize(path='/')
+
+    async def get(self, include_body: bool = True) -> None:
         details = tccontrol.get_conversion_details()
-        if details is None or details.get('original_firmware') is None:
+        if details is None or details.get('original_firmware_path') is None:
             raise HTTPError(400, 'original firmware not available')
 
-        self.set_header('Content-Type', 'application/octet-stream')
-        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self._details = details
+        await super().get(details['original_firmware_path'], include_body)
+
+    async def head(self) -> None:
+        await self.get(include_body=False)
+
+    @classmethod
+    def get_absolute_path(cls, root: str, path: str) -> str:
+        return path
+
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        if not os.path.isfile(absolute_path):
+            raise HTTPError(404)
+
+        return absolute_path
+
+    def compute_etag(self) -> Optional[str]:
+        return f'"{self._details["original_firmware_sha256"]}"'
+
+    def get_content_type(self) -> str:
+        return 'application/octet-stream'
+
+    def set_extra_headers(self, path: str) -> None:
+        # Clients may keep a copy, as long as they check it's still the same backup
+        self.set_header('Cache-Control', 'no-cache')
         self.set_header('Content-Disposition', 'attachment; filename="original.bin"')
 
-        self.finish(details['original_firmware'])
 
+@stream_request_body
+class FirmwareUploadHandler(RequestHandler):
+    _file: Optional[BinaryIO] = None
+
+    def prepare(self) -> None:
+        # Opening the firmware file truncates it, so only uploads may do that
+        if self.request.method != 'PUT':
+            return
+
+        if states.get_state() != states.STATE_CONVERTED:
+            raise HTTPError(400, 'firmware upload not allowed in current state')
+
+        self.request.connection.set_max_body_size(tccontrol.TCProcess.MAX_FIRMWARE_SIZE)
+        self._file = tccontrol.open_firmware()
+
+    async def data_received(self, chunk: bytes) -> None:
+        # Next chunk isn't read until this one has been written out
+        if self._file is not None:
+            await tccontrol.run_io(self._file.write, chunk)
+
+    def put(self) -> None:
+        tccontrol.close_firmware(self._file)
+        self._file = None
+
+        self.set_status(204)
+
+    def on_finish(self) -> None:
+        self._discard()
+
+    def on_connection_close(self) -> None:
+        self._discard()
+
+    def _discard(self) -> None:
+        # Upload was interrupted; close the file but don't mark the firmware as available
+        if self._file is not None:
+            logger.warning('firmware upload interrupted')
+            tccontrol.discard_firmware(self._file)
+            self._file = None
+
+
+class FirmwareProxyHandler(JSONRequestHandlerMixin, RequestHandler):
+    _download: Optional[FirmwareDownload] = None
 
-class FirmwareProxyHandler(RequestHandler):
     async def get(self) -> None:
-        http_client = AsyncHTTPClient()
         url = self.get_argument('url')
         logger.debug('proxy downloading firmware file at %s', url)
 
+        # Client is served from the cached file, as it gets downloaded, and at its own pace: a slow client doesn't make
+        # chunks pile up in memory
+        self._download = FirmwareDownload(url, tccontrol.get_firmware_cache())
+
         try:
-            response = await http_client.fetch(url)
+            await self._serve(url)
 
-        except HTTPClientError as e:
-            logger.error('failed to download file at %s', url, exc_info=True)
+        finally:
+            self._download.close()
 
-            raise HTTPError(status_code=e.code)
+    async def _serve(self, url: str) -> None:
+        # The first chunk has its image header checked, so nothing is sent to the client unless that passes
+        try:
+            await self._download.start()
+            chunk = await self._download.read()
+
+        except firmwareimage.FirmwareError as e:
+            logger.error('proxy downloaded invalid firmware file from %s: %s', url, e)
+            raise HTTPError(422, str(e))
 
-        except Exception:
+        except Exception as e:
             logger.error('failed to download file at %s', url, exc_info=True)
 
-            raise
+            content_length = self._download.content_length
+            if content_length is not None and content_length > FirmwareDownload.MAX_SIZE:
+                raise HTTPError(413, 'firmware file too large')
+
+            # Origin errors are passed on, other failures mean the origin couldn't be reached
+            status_code = e.code if isinstance(e, HTTPClientError) else 502
+            raise HTTPError(status_code, f'Could not download firmware: {e}')
+
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.set_header('X-Cache', 'HIT' if self._download.cached else 'MISS')
+        if self._download.content_length is not None:
+            self.set_header('Content-Length', self._download.content_length)
+
+        size = 0
+        while chunk:
+            self.write(chunk)
+            size += len(chunk)
+
+            try:
+                await self.flush()
+                chunk = await self._download.read()
+
+            except StreamClosedError:
+                return
+
+            except Exception:
+                logger.error('failed to download file at %s', url, exc_info=True)
 
-        else:
-            self.set_header('Content-Type', 'application/octet-stream')
-            self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
-            await self.finish(response.body)
+                # Part of the file has already been sent; abort the connection so that the client doesn't mistake it
+                # for a complete file
+                self.request.connection.close()
+                return
+
+        logger.debug('proxy served %s bytes from %s', size, url)
+        await self.finish()
+
+    def on_connection_close(self) -> None:
+        if self._download is not None:
+            self._download.close()
+
+
+class FirmwareCacheHandler(RequestHandler):
+    async def get(self) -> None:
+        stats = await tccontrol.run_io(tccontrol.get_firmware_cache().get_stats)
+
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.finish(stats)
+
+
+class BackupsHandler(RequestHandler):
+    async def get(self) -> None:
+        entries = await tccontrol.run_io(
+            tccontrol.get_backup_store().get_entries,
+            self.get_argument('mac', None),
+            self.get_argument('chip_id', None)
+        )
+
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.finish({'backups': entries})
+
+
+class BackupHandler(RequestHandler):
+    CHUNK_SIZE = 64 * 1024
+
+    async def get(self, id_: str) -> None:
+        store = tccontrol.get_backup_store()
+        entry = await tccontrol.run_io(store.get_entry, id_)
+        if entry is None:
+            raise HTTPError(404, 'no such backup')
+
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Content-Length', entry['size'])
+        self.set_header('Content-Disposition', f'attachment; filename="{entry["filename"]}"')
+        self.set_header('Etag', f'"{entry["sha256"]}"')
+
+        # Backups never change, so a client that already has one needn't download it again
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        # Older backups are compressed and decompressed on the fly
+        with await tccontrol.run_io(store.open, entry) as f:
+            while True:
+                chunk = await tccontrol.run_io(f.read, self.CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                self.write(chunk)
+                await self.flush()
+
+
+@stream_request_body
+class BatchHandler(UploadRequestHandlerMixin, RequestHandler):
+    def get(self) -> None:
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.finish({'batch': tccontrol.get_batch(), 'devices': tccontrol.get_batch_devices()})
+
+    async def put(self) -> None:
+        # Firmware image is the request body; backup and header patching policies are given as arguments
+        download_backup = self.get_argument('download_backup', 'true') == 'true'
+        patch_header = self.get_argument('patch_header', 'false') == 'true'
+
+        try:
+            await tccontrol.start_batch(await self.get_upload_path(), download_backup, patch_header)
+
+        except firmwareimage.FirmwareError as e:
+            raise HTTPError(400, str(e))
+
+        self.set_status(204)
+
+    def delete(self) -> None:
+        tccontrol.stop_batch()
+        self.set_status(204)
+
+
+@stream_request_body
+class FirmwareLibraryHandler(UploadRequestHandlerMixin, RequestHandler):
+    UPLOAD_METHOD = 'POST'
+
+    async def get(self) -> None:
+        entries = await tccontrol.run_io(tccontrol.get_firmware_library().get_entries)
+
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.finish({'firmwares': entries})
+
+    async def post(self) -> None:
+        # Firmware image is the request body
+        name = self.get_argument('name')
+        version = self.get_argument('version', None)
+
+        if self.upload_size < tccontrol.TCProcess.MIN_FIRMWARE_SIZE:
+            raise HTTPError(400, f'Firmware must have at least {tccontrol.TCProcess.MIN_FIRMWARE_SIZE} bytes')
+
+        library = tccontrol.get_firmware_library()
+
+        try:
+            entry = await tccontrol.run_io(library.add, await self.get_upload_path(), name, version)
+
+        except firmwareimage.FirmwareError as e:
+            raise HTTPError(400, str(e))
+
+        self.set_status(201)
+        self.finish(entry)
+
+
+class FirmwareLibraryEntryHandler(RequestHandler):
+    async def get(self, id_: str) -> None:
+        entry = await tccontrol.run_io(tccontrol.get_firmware_library().get_entry, id_)
+        if entry is None:
+            raise HTTPError(404, 'no such firmware')
+
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+        self.finish(entry)
+
+    async def delete(self, id_: str) -> None:
+        if not await tccontrol.run_io(tccontrol.get_firmware_library().remove, id_):
+            raise HTTPError(404, 'no such firmware')
+
+        self.set_status(204)
+
+
+class MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=UTF-8')
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+
+        self.finish(metrics.render())
+
+
+class MemoryHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+
+        self.finish(dict(metrics.get_memory_usage(), samples=metrics.get_memory_samples()))
+
+
+class DebugHandler(RequestHandler):
+    def prepare(self) -> None:
+        authorization = self.request.headers.get('Authorization', '')
+        token = authorization[7:] if authorization.startswith('Bearer ') else None
+        if not debug.check_token(token):
+            raise HTTPError(403)
+
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
+
+
+class DebugProfileHandler(DebugHandler):
+    MODES = ('cprofile', 'sample')
+
+    async def get(self) -> None:
+        try:
+            duration = float(self.get_argument('seconds', str(debug.DEFAULT_PROFILE_DURATION)))
+            top = int(self.get_argument('top', str(debug.DEFAULT_TOP)))
+
+        except ValueError:
+            raise HTTPError(400, 'invalid seconds or top')
+
+        if not 0 < duration <= debug.MAX_PROFILE_DURATION:
+            raise HTTPError(400, f'seconds must be between 0 and {debug.MAX_PROFILE_DURATION}')
+
+        mode = self.get_argument('mode', 'cprofile')
+        if mode not in self.MODES:
+            raise HTTPError(400, f'invalid mode {mode}')
+
+        sort = self.get_argument('sort', 'cumulative')
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise HTTPError(400, f'invalid sort key {sort}')
+
+        if debug.is_profiling():
+            raise HTTPError(409, 'profiling already in progress')
+
+        self.finish(await debug.profile(duration, mode, sort, top))
+
+
+class DebugMemoryHandler(DebugHandler):
+    KEY_TYPES = ('lineno', 'filename', 'traceback')
+
+    def get(self) -> None:
+        key_type = self.get_argument('key', 'lineno')
+        if key_type not in self.KEY_TYPES:
+            raise HTTPError(400, f'invalid key {key_type}')
+
+        try:
+            top = int(self.get_argument('top', str(debug.DEFAULT_TOP)))
+
+        except ValueError:
+            raise HTTPError(400, 'invalid top')
+
+        self.finish(debug.format_top_allocations(key_type, top))
+
+    def post(self) -> None:
+        debug.start_tracing()
+        self.set_status(204)
+
+    def delete(self) -> None:
+        debug.stop_tracing()
+        self.set_status(204)
+
+
+class DebugTasksHandler(DebugHandler):
+    def get(self) -> None:
+        self.finish(debug.format_tasks({
+            'tccontrol._conversion_task': tccontrol._conversion_task,
+            'tccontrol._flashing_task': tccontrol._flashing_task,
+            'tccontrol._standby_task': tccontrol._standby_task,
+            'tccontrol._stop_task': tccontrol._stop_task,
+            'states._update_task': getattr(states, '_update_task', None)
+        }))
+
+
+class DebugHandlersHandler(DebugHandler):
+    def get(self) -> None:
+        self.finish(debug.format_handler_stats())
 
 
 def make_handlers() -> List[tuple]:
-    return [
+    handlers = [
         (r'/', MainPageHandler),
         (r'/status', StatusHandler),
+        (r'/status/events', StatusEventsHandler),
+        (r'/log', LogHandler),
         (r'/firmware/original.bin', FirmwareOriginalHandler),
-        (r'/firmware/proxy', FirmwareProxyHandler)
+        (r'/firmware/custom.bin', FirmwareUploadHandler),
+        (r'/firmware/proxy', FirmwareProxyHandler),
+        (r'/firmware/cache', FirmwareCacheHandler),
+        (r'/firmware/library', FirmwareLibraryHandler),
+        (r'/firmware/library/([^/]+)', FirmwareLibraryEntryHandler),
+        (r'/backups', BackupsHandler),
+        (r'/backups/([^/]+)', BackupHandler),
+        (r'/batch', BatchHandler),
+        (r'/metrics', MetricsHandler),
+        (r'/memory', MemoryHandler)
     ]
 
+    # Debug endpoints don't even exist unless enabled
+    if debug.is_enabled():
+        handlers += [
+            (r'/debug/profile', DebugProfileHandler),
+            (r'/debug/memory', DebugMemoryHandler),
+            (r'/debug/tasks', DebugTasksHandler),
+            (r'/debug/handlers', DebugHandlersHandler)
+        ]
+
+    return handlers
+
 
 def make_app() -> Application:
+    settings = {}
+    if debug.is_enabled():
+        # Handler timings are recorded as requests are logged
+        settings['log_function'] = debug.log_request
+
     return Application(
         handlers=make_handlers(),
         template_path=os.path.join(os.path.dirname(__file__), 'templates'),
-        static_path=os.path.join(os.path.dirname(__file__), 'static'),
+        static_path=staticfiles.STATIC_DIR,
+        static_handler_class=staticfiles.PrecompressedStaticFileHandler,
         debug=False,
-        compiled_template_cache=False
+        compiled_template_cache=True,
+        **settings
     )
@@ -0,0 +1,72 @@
+
+import asyncio
+import json
+import socket
+
+from typing import Any, Dict, Optional
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest, HTTPResponse
+from tornado.testing import AsyncTestCase
+
+from benchmarks import conversion
+
+
+# Transcripts are replayed fast, but not so fast that output arrives before tcfrontend is ready for it
+SPEED = 20
+TIMEOUT = 60
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerTestCase(AsyncTestCase):
+    # Runs a tcfrontend server against the tuya-convert simulator, like the conversion benchmark, once per test class
+    TRANSCRIPT = 'conversion.jsonl'
+    SPEED = SPEED
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.port = get_free_port()
+        cls.server, cls.tc_dir = conversion.start_server(cls.port, cls.TRANSCRIPT, cls.SPEED)
+        asyncio.run(conversion.wait_server(cls.port))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        conversion.stop_server(cls.server, cls.tc_dir)
+
+    async def fetch(self, path: str, method: str = 'GET', body: Optional[Any] = None) -> HTTPResponse:
+        request = HTTPRequest(
+            f'http://127.0.0.1:{self.port}{path}',
+            method=method,
+            body=json.dumps(body) if body is not None else None,
+            headers={'Content-Type': 'application/json'} if body is not None else None,
+            request_timeout=TIMEOUT
+        )
+
+        try:
+            return await AsyncHTTPClient().fetch(request)
+
+        except HTTPClientError as e:
+            if e.response is None:
+                raise
+
+            return e.response
+
+    async def request_state(self, state: str, **params: Any) -> HTTPResponse:
+        return await self.fetch('/status', 'PATCH', {'state': state, 'params': params})
+
+    async def get_state(self) -> Dict[str, Any]:
+        return json.loads((await self.fetch('/status')).body)
+
+    async def wait_state(self, *states: str) -> Dict[str, Any]:
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + TIMEOUT
+        while True:
+            status = await self.get_state()
+            if status['state'] in states or loop.time() > deadline:
+                return status
+
+            await asyncio.sleep(0.1)
@@ -0,0 +1,40 @@
+
+import asyncio
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.testing import gen_test
+
+from tests.server import ServerTestCase, TIMEOUT
+
+
+class FailedConversionLogTestCase(ServerTestCase):
+    # Device never shows up; timeouts shrink with the speed, so that retries give up quickly
+    TRANSCRIPT = 'no-device.jsonl'
+    SPEED = 100
+
+    # Long enough for the standby process started after the failure to produce output
+    STANDBY_DELAY = 1
+
+    async def read_log(self) -> bytes:
+        # Log is streamed until the client disconnects, so whatever arrives in time is taken
+        chunks = []
+        request = HTTPRequest(f'http://127.0.0.1:{self.port}/log', streaming_callback=chunks.append, request_timeout=1)
+        try:
+            await AsyncHTTPClient().fetch(request)
+
+        except HTTPClientError as e:
+            if e.code != 599:
+                raise
+
+        return b''.join(chunks)
+
+    @gen_test(timeout=TIMEOUT)
+    async def test_log_kept_after_failure(self) -> None:
+        response = await self.request_state('converting', download_backup=False)
+        self.assertEqual(response.code, 200)
+
+        status = await self.wait_state('conversion-error')
+        self.assertEqual(status['state'], 'conversion-error')
+
+        await asyncio.sleep(self.STANDBY_DELAY)
+        self.assertIn(b'Device did not appear with the intermediate firmware', await self.read_log())
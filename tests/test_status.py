@@ -0,0 +1,52 @@
+
+import base64
+import json
+
+from tornado.testing import gen_test
+
+from benchmarks.firmwareimage import make_image
+from tests.server import ServerTestCase, TIMEOUT
+
+
+class FlashRequestTestCase(ServerTestCase):
+    # Flashing requests that can't be carried out are rejected with the reason, leaving the conversion in place
+    async def convert(self) -> None:
+        status = await self.get_state()
+        if status['state'] == 'ready':
+            response = await self.request_state('converting', download_backup=False)
+            self.assertEqual(response.code, 200)
+
+        status = await self.wait_state('converted', 'conversion-error')
+        self.assertEqual(status['state'], 'converted')
+
+    async def assert_rejected(self, code: int, message: str, **params) -> None:
+        await self.convert()
+
+        response = await self.request_state('flashing', **params)
+        self.assertEqual(response.code, code)
+        self.assertEqual(response.headers['Content-Type'], 'application/json; charset=UTF-8')
+        self.assertIn(message, json.loads(response.body)['error'])
+
+        self.assertEqual((await self.get_state())['state'], 'converted')
+
+    @gen_test(timeout=TIMEOUT)
+    async def test_invalid_image(self) -> None:
+        firmware = base64.urlsafe_b64encode(bytes(4096)).decode()
+        await self.assert_rejected(422, 'magic byte', firmware=firmware)
+
+    @gen_test(timeout=TIMEOUT)
+    async def test_flash_params_mismatch(self) -> None:
+        firmware = base64.urlsafe_b64encode(make_image(4096)).decode()
+        await self.assert_rejected(422, 'does not match device', firmware=firmware)
+
+    @gen_test(timeout=TIMEOUT)
+    async def test_invalid_base64(self) -> None:
+        await self.assert_rejected(400, 'Invalid params', firmware='not base64!')
+
+    @gen_test(timeout=TIMEOUT)
+    async def test_unknown_firmware_id(self) -> None:
+        await self.assert_rejected(400, 'No such firmware', firmware_id='nonexistent')
+
+    @gen_test(timeout=TIMEOUT)
+    async def test_unreachable_firmware_url(self) -> None:
+        await self.assert_rejected(400, 'Could not download firmware', firmware_url='http://127.0.0.1:1/firmware.bin')